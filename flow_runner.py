@@ -1,12 +1,9 @@
-# runs flower tasks every X minutes
+# runs flow pipelines in a pool of workers when they are due by their schedule
 
 import os
-import time
 
-from gutterlib.flow.GutterFlow import GutterFlow
-from gutterlib.datastore.GutterStore import GutterStore
+from gutterlib.flow.FlowRunner import FlowRunner
 
-import logging
 
 """ SETTINGS
     
@@ -14,48 +11,28 @@ import logging
 
 """
 
-LOOP_SECONDS = 60*5 # loop every X seconds
+RELOAD_SECONDS = 60 # reload pipeline schedules from database every X seconds
 
-GUTTER_DATABASE = { 'type' : os.environ.get('GUTTER_DB_TYPE'), 
+GUTTER_DATABASE = { 'db_type' : os.environ.get('GUTTER_DB_TYPE'), 
                     'url' : os.environ.get('GUTTER_DB_URL'), 
                     'port' : os.environ.get('GUTTER_DB_PORT'), 
                     'user' : os.environ.get('GUTTER_DB_USER'), 
                     'password' : os.environ.get('GUTTER_DB_PASSWORD'), 
                     'name' : os.environ.get('GUTTER_DB_NAME') }
 
-#### END SETTINGS ####
-
-gutterFlow = GutterFlow()
-gutterFlow.connect(**GUTTER_DATABASE)
-
-gutterStore = GutterStore()
-gutterStore.connect( **GUTTER_DATABASE )
+WORKERS = int(os.environ.get('GUTTER_RUNNER_WORKERS', 4)) # number of pipelines that can run at the same time
+WORKER_TYPE = os.environ.get('GUTTER_RUNNER_WORKER_TYPE', 'thread') # thread or process
+WORKER_MAX_MEMORY_MB = os.environ.get('GUTTER_RUNNER_WORKER_MAX_MEMORY_MB') # only for process workers
+WORKER_MAX_JOBS = os.environ.get('GUTTER_RUNNER_WORKER_MAX_JOBS') # only for process workers: new process after X jobs
 
-gutterFlow.connectGutterStore( gutterStore )
-
-print ('==== start python runner ====')
+#### END SETTINGS ####
 
-while True:
-    
-    try:
-        l = "Run flow @{0}".format(time.ctime())
-        print (l)
-        
-        # do the job
-        try:
-            r = gutterFlow.doJobs()
-            if not r:
-                print ('=> no jobs to do!') 
-        
-        except Exception as e:
-            print (e)
-        
-        # go to sleep
-        time.sleep( LOOP_SECONDS )
-        
-
-    except Exception as e:
-        print (e)
+if __name__ == '__main__':
 
+    print ('==== start python runner ====')
 
+    flowRunner = FlowRunner(GUTTER_DATABASE, workers=WORKERS, worker_type=WORKER_TYPE,
+                            max_memory_mb=WORKER_MAX_MEMORY_MB, max_jobs_per_worker=WORKER_MAX_JOBS)
+    flowRunner.RELOAD_SECONDS = RELOAD_SECONDS
 
+    flowRunner.start()
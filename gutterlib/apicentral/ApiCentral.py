@@ -32,14 +32,22 @@ from flask import json
 from flask_restplus import Namespace, Resource, reqparse
 from flask import request
 from flask import jsonify
+from flask import Response, stream_with_context
 
 from flask_restplus import Api
 
 import uuid
 import logging
 import datetime
+from urllib.parse import urlencode
 import time
 
+# $format : ( format of RequestHandler.get_data_stream, mimetype )
+STREAM_FORMATS = {
+    'ndjson': ('ndjson', 'application/x-ndjson'),
+    'jsonstream': ('json', 'application/json'),
+}
+
 
 class ApiCentral:
 
@@ -320,17 +328,52 @@ class ApiCentral:
             def get(self):
                 parser = reqparse.RequestParser()
                 parser.add_argument('$filter', type=str, help="Filter the data. Ex: 'column_name' eq 1000'")
+                parser.add_argument('$select', type=str, help="Only these fields. Ex: 'name,locatie.latitude'")
                 parser.add_argument('$top', type=int, help='Limit results to a certain number')
                 parser.add_argument('$skip', type=int, help='Skip certain results')
                 parser.add_argument('$orderBy', type=str, help='Order by column')
-                parser.add_argument('$format', type=str, help='Special output formats besides json')
+                parser.add_argument('$format', type=str, help='Special output formats besides json: geojson, ndjson or jsonstream ( streamed without row limit )')
+                parser.add_argument('$after', type=str, help='Cursor of the next page ( see Link header )')
+                parser.add_argument('$count', type=str, help="'true' for total number of rows in X-Total-Count header ( estimated for large results )")
 
                 args = parser.parse_args()
 
+                headers = {}
+
+                if (args.get('$count') or '').lower() == 'true':
+                    count = request_handler.get_data_count(api_end_point=end_point_definition, request_data=args)
+
+                    if count is not None:
+                        headers['X-Total-Count'] = str(count[0])
+                        headers['X-Total-Count-Exact'] = 'true' if count[1] else 'false'
+
+                # streaming formats for large exports: rows are written while they are read
+                if args.get('$format') in STREAM_FORMATS:
+                    format_, mimetype = STREAM_FORMATS[args.get('$format')]
+                    data_stream = request_handler.get_data_stream(api_end_point=end_point_definition, request_data=args, format_=format_)
+
+                    if data_stream is False:
+                        return { "status" : "error", "message" : "Cannot get data" }, 500
+
+                    return Response(stream_with_context(data_stream), headers=headers, mimetype=mimetype)
+
                 # return list of dicts / or geojson
-                data_rows = request_handler.get_data_list(api_end_point=end_point_definition, request_data=args)
+                data_rows, next_cursor = request_handler.get_data_page(api_end_point=end_point_definition, request_data=args, as_text=True)
+
+                if isinstance(data_rows, GutterStoreError):
+                    return { "status" : "error", "message" : data_rows.msg }, data_rows.status_code or 500
+
+                if next_cursor is not None:
+                    # next page continues after the last row: no $skip needed
+                    next_args = [(key, value) for key, value in request.args.items(multi=True) if key not in ['$after', '$skip']]
+                    next_args.append(('$after', next_cursor))
+                    headers['Link'] = '<{0}?{1}>; rel="next"'.format(request.base_url, urlencode(next_args))
+
+                if isinstance(data_rows, str):
+                    # json text from database: as it is, without decoding and encoding again
+                    return Response(data_rows, status=200, headers=headers, mimetype='application/json')
 
-                return data_rows
+                return data_rows, 200, headers
 
             @decorate_conditional(end_point_definition.anonymous_access is not True, jwt_required)
             @api.doc('Upload a {0}'.format(end_point_definition.unit))
@@ -482,6 +525,7 @@ class ApiCentral:
             return False
 
         for end_point in end_points:
+            self.gutter_store.upgrade_storage_table(end_point.gutter_table)  # tables from before new columns
             api_namespace = self.get_api_namespace_for_end_point(end_point)
             self.api_root.add_namespace(api_namespace, path='/' + end_point.endpoint)
             self.logger.info("Created API '{0}' on endpoint '{1}'".format(end_point.name, end_point.endpoint))
@@ -773,7 +817,7 @@ class ApiCentral:
             return False
 
         try:
-            CORS(app)
+            CORS(app, expose_headers=['Link', 'X-Total-Count', 'X-Total-Count-Exact'])  # paging headers for browser clients
         except Exception as e:
             self.logger.error("Cannot set CORS: {0}".format(e))
 
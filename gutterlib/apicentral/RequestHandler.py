@@ -20,6 +20,9 @@ class RequestHandler:
 
     def __init__(self, api_central=None):
 
+        # settings
+        self.STREAM_CHUNK_ROWS = 500  # rows per chunk written to client when streaming
+
         # api_end_point = api_end_point
         self.api_central = api_central
         self.gutter_store = None
@@ -110,7 +113,68 @@ class RequestHandler:
 
     def get_data_list(self, api_end_point, request_data):
 
-        # request data: $filter, $select (disabled), $top, $skip, $order_by
+        data, next_cursor = self.get_data_page(api_end_point, request_data)
+
+        return data
+
+    # ----
+
+    def get_data_page(self, api_end_point, request_data, as_text=False):
+
+        # request data: $filter, $select, $top, $skip, $order_by, $after
+        # returns ( data, cursor of next page or None )
+        # as_text: plain json lists as json text made by the database ( see GutterStore.get_data_page_text )
+
+        if not self.check_gutter_store():
+            self.logger.error("No connection with GutterStore")
+            return False, None
+
+        if not api_end_point:
+            self.logger.error("Cannot get data without api_end_point")
+            return False, None
+
+        query_args = self.get_query_args(api_end_point, request_data)
+
+        # for special output like geojson
+        format_ = request_data.get('$format')
+
+        # keyset pagination: $after is the cursor of the previous page ( instead of $skip )
+        after = request_data.get('$after')
+
+        # request data from gutter store
+        return self.gutter_store.get_data_page(
+            table_name=api_end_point.gutter_table,
+            schema_definition=api_end_point.schema_definition,
+            format=format_, after=after, as_text=as_text, **query_args)
+
+    # ----
+
+    def get_data_count(self, api_end_point, request_data):
+
+        # number of rows that match $filter ( for $count )
+        # returns ( count, is_exact ) or None
+
+        if not self.check_gutter_store():
+            return None
+
+        if not api_end_point:
+            self.logger.error("Cannot count data without api_end_point")
+            return None
+
+        query_args = self.get_query_args(api_end_point, request_data)
+
+        return self.gutter_store.get_data_count(
+            table_name=api_end_point.gutter_table,
+            schema_definition=api_end_point.schema_definition,
+            filters=query_args['filters'])
+
+    # ----
+
+    def get_data_stream(self, api_end_point, request_data, format_='ndjson'):
+
+        # stream data rows as encoded text for large exports: without $top all rows
+        # format_: 'ndjson' ( one json object per line ) or 'json' ( one json array )
+        # returns generator of str chunks or False
 
         if not self.check_gutter_store():
             self.logger.error("No connection with GutterStore")
@@ -120,6 +184,50 @@ class RequestHandler:
             self.logger.error("Cannot get data without api_end_point")
             return False
 
+        query_args = self.get_query_args(api_end_point, request_data)
+
+        rows = self.gutter_store.iter_data(
+            table_name=api_end_point.gutter_table,
+            schema_definition=api_end_point.schema_definition, **query_args)
+
+        return self.encode_data_stream(rows, format_)
+
+    # ----
+
+    def encode_data_stream(self, rows, format_='ndjson'):
+
+        # NOTE: rows are written in chunks of STREAM_CHUNK_ROWS: not too many small writes to the client
+        chunk = []
+        first = True
+
+        if format_ == 'json':
+            yield '['
+
+        for row in rows:
+            if format_ == 'json':
+                chunk.append(('' if first else ',') + json.dumps(row, default=str))
+            else:
+                chunk.append(json.dumps(row, default=str) + '\n')
+
+            first = False
+
+            if len(chunk) >= self.STREAM_CHUNK_ROWS:
+                yield ''.join(chunk)
+                chunk = []
+
+        if len(chunk) > 0:
+            yield ''.join(chunk)
+
+        if format_ == 'json':
+            yield ']'
+
+    # ----
+
+    def get_query_args(self, api_end_point, request_data):
+
+        # request data to arguments for GutterStore.get_data_page and iter_data
+        # returns dict with select, filters, limit, offset, order_by, order_by_type
+
         # request is flask object containing: (response=None, status=None, headers=None, mimetype=None, content_type=None, direct_passthrough=False) 
         # see: http://flask.pocoo.org/docs/1.0/api/#flask.request
 
@@ -193,17 +301,14 @@ class RequestHandler:
                 order_by = None
                 order_by_type = None
 
-        # for special output like geojson
-        format_ = request_data.get('$format')
+        # $select=name,locatie.latitude: only these fields ( nested fields are checked by GutterStore )
+        select = None
 
-        # request data from gutter store
-        return self.gutter_store.get_data_list(
-            table_name=api_end_point.gutter_table,
-            schema_definition=api_end_point.schema_definition,
-            select=None, filters=filters,
-            limit=top, offset=skip,
-            order_by=order_by, order_by_type=order_by_type,
-            format=format_)
+        if request_data.get('$select') is not None:
+            select = [column_name.strip() for column_name in request_data.get('$select').split(',') if column_name.strip() != '']
+
+        return {'select': select, 'filters': filters, 'limit': top, 'offset': skip,
+                'order_by': order_by, 'order_by_type': order_by_type}
 
     # ----
 
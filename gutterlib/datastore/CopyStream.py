@@ -0,0 +1,62 @@
+""" File like object to feed rows to Postgres COPY ... FROM STDIN
+
+    psycopg2 reads the stream in chunks ( cursor.copy_expert ), so rows come from
+    a generator and never have to be in memory all at once
+
+"""
+
+import csv
+import io
+
+
+class CopyStream:
+
+    def __init__(self, rows, columns):
+
+        """
+        :param rows: iterable of dicts
+        :param columns: names of the keys in the rows in order of the COPY columns
+
+        """
+
+        self.rows = iter(rows)
+        self.columns = columns
+        self.buffer = ''
+        self.num_rows = 0
+
+    # ----
+
+    def read(self, size=-1):
+
+        while size < 0 or len(self.buffer) < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+
+            self.buffer += self.format_row(row)
+            self.num_rows += 1
+
+        if size < 0:
+            size = len(self.buffer)
+
+        chunk = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+
+        return chunk
+
+    # ----
+
+    def readline(self, size=-1):
+
+        return self.read(size)
+
+    # ----
+
+    def format_row(self, row):
+
+        # CSV line: None becomes an empty unquoted field which COPY reads as NULL
+        line = io.StringIO()
+        csv.writer(line).writerow([row.get(column) for column in self.columns])
+
+        return line.getvalue()
@@ -9,21 +9,28 @@
 """
 
 from .GutterStoreError import GutterStoreError
+from .CopyStream import CopyStream
+from .ModelRegistry import ModelRegistry
 
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Numeric, DateTime
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import Column, Integer, String, Numeric, DateTime, Index, Text
+from sqlalchemy.dialects.postgresql import JSONB, aggregate_order_by
 from sqlalchemy.sql.expression import cast
 from sqlalchemy import desc
 from sqlalchemy import func
+from sqlalchemy import text
+from sqlalchemy import tuple_, literal, literal_column, and_, or_, case
 
 import operator
 import logging
 import datetime
 import re
 import uuid
+import hashlib
+import base64
+import time
+import threading
 import simplejson as json
 
 import geojson
@@ -32,7 +39,12 @@ from functools import partial
 import pyproj
 from shapely.ops import transform
 
-DBObj = declarative_base()
+# dynamic models of gutter tables: shared by all GutterStore instances ( one per request or pipeline run )
+MODEL_REGISTRY = ModelRegistry(max_size=256)
+
+# recent row counts: ( table_name, filters key ) : ( time, count, is_exact ). See get_data_count
+COUNT_CACHE = {}
+COUNT_CACHE_LOCK = threading.Lock()
 
 
 class GutterStore:
@@ -42,6 +54,10 @@ class GutterStore:
         # settings
         self.GET_NUM_ROWS_DEFAULT = 2000
         self.GET_MAX_ROWS = 10000
+        self.STREAM_BATCH_SIZE = 1000  # rows fetched at once when streaming ( see iter_data )
+        self.COUNT_EXACT_MAX_ROWS = 100000  # count exactly when the estimate is below this, otherwise give estimate
+        self.COUNT_CACHE_SECONDS = 60
+        self.COUNT_CACHE_MAX_SIZE = 1024
 
         # properties
         self.db_engine = None
@@ -53,9 +69,6 @@ class GutterStore:
         self.logger = None
         self.has_connection = False
 
-        self.storage_models_cache = {}  # key by table name
-        self.storage_history_models_cache = {}
-
         # setup
         self.setup_logger()
 
@@ -124,25 +137,40 @@ class GutterStore:
 
     # ----
 
+    def disconnect(self):
+
+        # close session and all connections ( for example at the end of a worker job )
+        if self.db_session is not None:
+            self.db_session.close()
+
+        if self.db_engine:
+            self.db_engine.dispose()
+
+        self.has_connection = False
+
+    # ----
+
     def get_storage_model(self, table_name):
 
-        if self.storage_models_cache.get(table_name) is not None:
-            return self.storage_models_cache.get(table_name)
+        # get a model for a row in which gutter saves all data: made once ( see ModelRegistry )
+        return MODEL_REGISTRY.get_model(table_name, 'storage', self.make_storage_model)
+
+    # ----
 
-        # get a model for a row in which gutter saves all data
+    def make_storage_model(self, table_name, Base):
 
         TABLE_PRE_STRING = ""  # can be "gutter_" for example
         TABLE_POST_STRING = ""  # can be "_gutter" for example
 
         # ==== dynamic StorageRow class ====
 
-        class StorageRow(DBObj):
+        class StorageRow(Base):
 
-            DBObj.metadata.clear()
             # basic model for saving all data rows
 
             __tablename__ = TABLE_PRE_STRING + table_name + TABLE_POST_STRING  # to extend
-            __table_args__ = {"schema": "gutter_data"}  # hack to specify schema
+            __table_args__ = (Index(GutterStore.get_index_name(table_name, 'id_datahash'), 'id', 'datahash'),  # sync only reads these
+                              {"schema": "gutter_data"})  # hack to specify schema
 
             id = Column(String(), primary_key=True)  # string
             created_by = Column(String())
@@ -151,6 +179,7 @@ class GutterStore:
             last_updated = Column(DateTime)
             pipeline_id = Column(Integer())
             data = Column(JSONB())
+            datahash = Column(String())  # digest of data: see GutterStore.get_data_hash
 
             # ----
 
@@ -192,7 +221,7 @@ class GutterStore:
                 self.last_updated = last_updated or datetime.datetime.now()
                 self.pipeline_id = pipeline_id
                 self.data = data
-                self.datahash = datahash
+                self.datahash = datahash or GutterStore.get_data_hash(data)
 
 
             # ----
@@ -251,32 +280,31 @@ class GutterStore:
                     return False
 
                 try:
-                    DBObj.metadata.create_all(engine)
+                    self.metadata.create_all(engine)  # own metadata: only this table
 
                 except Exception as e:
                     print("ERROR: Can't create table for GutterRow: {0}".format(e))
 
         # ==== end StorageRow class ====
 
-        # save in cache
-        self.storage_models_cache[table_name] = StorageRow
-
         return StorageRow
 
     # ----
 
     def get_history_model(self, table_name):
 
-        # get a model for a row in which gutter saves all data
+        # get a model for a row in which gutter saves all data: made once ( see ModelRegistry )
+        return MODEL_REGISTRY.get_model(table_name, 'history', self.make_history_model)
+
+    # ----
 
-        if self.storage_history_models_cache.get(table_name) is not None:
-            return self.storage_history_models_cache.get(table_name)
+    def make_history_model(self, table_name, Base):
 
         TABLE_POST_STRING = "_history"
 
         # ==== dynamic StorageHistoryRow class ====
 
-        class StorageHistoryRow(DBObj):
+        class StorageHistoryRow(Base):
 
             # basic model for saving all data rows
 
@@ -346,19 +374,97 @@ class GutterStore:
                     return False
 
                 try:
-                    DBObj.metadata.create_all(engine)
+                    self.metadata.create_all(engine)  # own metadata: only this table
 
                 except Exception as e:
                     print("Error: can't create table for gutter_history_row: {0}".format(e))
 
         # ==== end dynamic StorageHistoryRow class ====
 
-        self.storage_history_models_cache[table_name] = StorageHistoryRow
-
         return StorageHistoryRow
 
     # ----
 
+    def upgrade_storage_table(self, table_name):
+
+        """ Bring existing storage tables up to date with the StorageRow model
+            ( create_all only creates missing tables, it does not add columns )
+        
+        """
+
+        sqls = ['ALTER TABLE gutter_data."{0}" ADD COLUMN IF NOT EXISTS datahash VARCHAR'.format(table_name),
+                'CREATE INDEX IF NOT EXISTS "{1}" ON gutter_data."{0}" (id, datahash)'.format(
+                    table_name, self.get_index_name(table_name, 'id_datahash'))]
+
+        for sql in sqls:
+            try:
+                self.db_session.execute(sql)
+                self.db_session.commit()
+            except Exception as e:
+                self.db_session.rollback()
+                self.logger.error("upgrade_storage_table failed for table '{0}': {1}".format(table_name, e))
+                return False
+
+        return True
+
+    # ----
+
+    @staticmethod
+    def get_data_hash(data):
+
+        """ Stable digest of row data to detect changes without comparing ( or even loading ) the data
+            We hash canonical JSON: sorted keys and no whitespace
+        
+        :return: str or None -- 
+        
+        """
+
+        if data is None:
+            return None
+
+        canonical_json = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str, ensure_ascii=False)
+
+        return hashlib.md5(canonical_json.encode('utf8')).hexdigest()
+
+    # ----
+
+    def get_datahashes_by_ids(self, table_name, ids=[]):
+
+        """ Get only ids and data hashes of stored rows ( uses index on (id, datahash) )
+        
+        :return: dict -- { id : datahash }
+        
+        """
+
+        if len(ids) == 0:
+            return {}
+
+        sql = 'SELECT id, datahash FROM gutter_data."{0}" WHERE id = ANY(:ids)'.format(table_name)
+
+        rows = self.db_session.execute(text(sql), {'ids': [str(id) for id in ids]}).fetchall()
+
+        return {row['id']: row['datahash'] for row in rows}
+
+    # ----
+
+    def touch_rows(self, table_name, ids=[]):
+
+        """ Set last_checked of rows that are still the same in the source
+            NOTE: like add_rows this does not commit
+        
+        """
+
+        if len(ids) == 0:
+            return 0
+
+        sql = 'UPDATE gutter_data."{0}" SET last_checked = :now WHERE id = ANY(:ids)'.format(table_name)
+
+        r = self.db_session.execute(text(sql), {'ids': [str(id) for id in ids], 'now': datetime.datetime.now()})
+
+        return r.rowcount
+
+    # ----
+
     def add_rows(self, rows):
 
         self.db_session.add_all(rows)
@@ -371,6 +477,235 @@ class GutterStore:
 
     # ----
 
+    def bulk_upsert(self, table_name=None, rows=None, pipeline_id=None, keep_history=True):
+
+        """ Insert new rows and update changed rows of a batch in one statement
+        
+            INSERT ... ON CONFLICT (id) DO UPDATE ... WHERE data IS DISTINCT FROM EXCLUDED.data
+            
+            The comparison of data happens in the database and no ORM objects are made. In the same statement 
+            the old data of updated rows is saved in the history table and last_checked of unchanged rows is set.
+            Rows are compared on datahash, for older rows without datahash on data
+            NOTE: like add_rows this does not commit
+        
+        :param table_name: Name of gutter table
+        :param rows: list of dicts { id, data, datahash ( optional ) }
+        :param pipeline_id: Id of pipeline that supplies the rows
+        :param keep_history: Save the old data of updated rows in <<table_name>>_history
+        :return: dict { new, updates, same } or None --
+        
+        """
+
+        if table_name is None or rows is None:
+            self.logger.error("bulk_upsert failed: missing parameters table_name or rows")
+            return None
+
+        if len(rows) == 0:
+            return {'new': 0, 'updates': 0, 'same': 0}
+
+        rows = [{'id': row['id'], 'data': row['data'],
+                 'datahash': row.get('datahash') or self.get_data_hash(row['data'])} for row in rows]
+
+        incoming_sql = """
+            SELECT DISTINCT ON (id) id, data, datahash 
+            FROM jsonb_to_recordset(CAST(:rows AS jsonb)) AS r(id text, data jsonb, datahash text)
+        """
+
+        sql = self.get_upsert_sql(table_name, incoming_sql, keep_history)
+
+        try:
+            r = self.db_session.execute(text(sql), {'rows': json.dumps(rows, default=str),
+                                                    'now': datetime.datetime.now(),
+                                                    'pipeline_id': pipeline_id}).fetchone()
+
+            return {'new': r['new'], 'updates': r['updates'], 'same': r['same']}
+
+        except Exception as e:
+            self.db_session.rollback()
+            self.logger.error("bulk_upsert failed for table '{0}': {1}".format(table_name, e))
+            return None
+
+    # ----
+
+    def get_upsert_sql(self, table_name, incoming_sql, keep_history=True):
+
+        """ SQL for upserting rows coming from incoming_sql ( id, data, datahash ) into a storage table
+            Parameters are :now and :pipeline_id. See bulk_upsert
+        
+        :return: str --
+        
+        """
+
+        history_sql = ""
+
+        if keep_history:
+            history_sql = """,
+                history AS (
+                    INSERT INTO gutter_data."{0}_history" (row_id, valid_from, valid_to, pipeline_id, data)
+                    SELECT previous.id, previous.last_updated, :now, :pipeline_id, previous.data 
+                    FROM previous JOIN upserted ON upserted.id = previous.id 
+                    WHERE NOT upserted.inserted
+                    RETURNING row_id
+                )""".format(table_name)
+
+        # NOTE: all parts of the statement see the same snapshot: previous contains the data before the upsert
+        return """
+            WITH incoming AS ({1}),
+            previous AS (
+                SELECT t.id, t.data, t.last_updated 
+                FROM gutter_data."{0}" AS t JOIN incoming ON incoming.id = t.id
+            ),
+            upserted AS (
+                INSERT INTO gutter_data."{0}" AS t (id, created_at, last_checked, last_updated, pipeline_id, data, datahash)
+                SELECT id, :now, :now, :now, :pipeline_id, data, datahash FROM incoming
+                ON CONFLICT (id) DO UPDATE 
+                    SET data = EXCLUDED.data, datahash = EXCLUDED.datahash, 
+                        last_checked = EXCLUDED.last_checked, last_updated = EXCLUDED.last_updated
+                    WHERE CASE WHEN t.datahash IS NULL THEN t.data IS DISTINCT FROM EXCLUDED.data 
+                               ELSE t.datahash <> EXCLUDED.datahash END
+                RETURNING t.id, (t.xmax = 0) AS inserted
+            ),
+            checked AS (
+                UPDATE gutter_data."{0}" AS t SET last_checked = :now, datahash = incoming.datahash 
+                FROM incoming 
+                WHERE incoming.id = t.id AND incoming.id IN (SELECT id FROM previous) 
+                    AND incoming.id NOT IN (SELECT id FROM upserted)
+                RETURNING t.id
+            ){2}
+            SELECT (SELECT count(*) FROM upserted WHERE inserted) AS new,
+                   (SELECT count(*) FROM upserted WHERE NOT inserted) AS updates,
+                   (SELECT count(*) FROM checked) AS same
+        """.format(table_name, incoming_sql, history_sql)
+
+    # ----
+
+    def copy_rows(self, table_name=None, rows=None, pipeline_id=None, staging=False, keep_history=True):
+
+        """ Load many rows fast with COPY ... FROM STDIN ( CSV )
+        
+            Without staging the rows go straight into the table: only for empty tables ( initial load ).
+            With staging they are copied into a temporary table first and then inserted or updated 
+            in one statement like bulk_upsert does
+            NOTE: this commits
+        
+        :param table_name: Name of gutter table
+        :param rows: iterable ( can be a generator ) of dicts { id, data, datahash ( optional ) }
+        :param pipeline_id: Id of pipeline that supplies the rows
+        :param staging: Copy to a temporary table first
+        :param keep_history: Save the old data of updated rows in <<table_name>>_history ( with staging )
+        :return: dict { new, updates, same } or None --
+        
+        """
+
+        if table_name is None or rows is None:
+            self.logger.error("copy_rows failed: missing parameters table_name or rows")
+            return None
+
+        COPY_COLUMNS = ['id', 'created_at', 'last_checked', 'last_updated', 'pipeline_id', 'data', 'datahash']
+
+        now = datetime.datetime.now()
+
+        def csv_rows():
+            for row in rows:
+                yield {'id': row['id'], 'created_at': now, 'last_checked': now, 'last_updated': now,
+                       'pipeline_id': pipeline_id, 'data': json.dumps(row['data'], default=str),
+                       'datahash': row.get('datahash') or self.get_data_hash(row['data'])}
+
+        try:
+            # raw psycopg2 cursor within the transaction of our session
+            cursor = self.db_session.connection().connection.cursor()
+
+            if staging:
+                cursor.execute('CREATE TEMPORARY TABLE gutter_copy_staging '
+                               '(LIKE gutter_data."{0}") ON COMMIT DROP'.format(table_name))
+                copy_target = 'gutter_copy_staging'
+            else:
+                copy_target = 'gutter_data."{0}"'.format(table_name)
+
+            stream = CopyStream(csv_rows(), COPY_COLUMNS)
+            cursor.copy_expert('COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)'.format(
+                copy_target, ', '.join(COPY_COLUMNS)), stream)
+
+            if staging:
+                # last copied row wins for duplicate ids
+                incoming_sql = 'SELECT DISTINCT ON (id) id, data, datahash FROM gutter_copy_staging ORDER BY id, ctid DESC'
+                r = self.db_session.execute(text(self.get_upsert_sql(table_name, incoming_sql, keep_history)),
+                                            {'now': now, 'pipeline_id': pipeline_id}).fetchone()
+                results = {'new': r['new'], 'updates': r['updates'], 'same': r['same']}
+            else:
+                results = {'new': stream.num_rows, 'updates': 0, 'same': 0}
+
+            self.db_session.commit()
+
+            return results
+
+        except Exception as e:
+            self.db_session.rollback()
+            self.logger.error("copy_rows failed for table '{0}': {1}".format(table_name, e))
+            return None
+
+    # ----
+
+    def delete_missing_rows(self, table_name=None, seen_ids=None, pipeline_id=None):
+
+        """ Delete the rows of a pipeline that were not seen in the source anymore
+        
+            The seen ids go to the database as one sorted array that is anti-joined with the table: 
+            no storage rows are loaded. The data of deleted rows is closed in the history table 
+            ( valid_to is now ) in the same statement, so it is never lost: the table <<table_name>>_history 
+            has to exist. Rows added by users ( without pipeline_id ) are kept
+            NOTE: like add_rows this does not commit
+        
+        :param table_name: Name of gutter table
+        :param seen_ids: iterable of ids of all rows in the source
+        :param pipeline_id: Id of pipeline that supplied the rows
+        :return: int or None -- number of deleted rows
+        
+        """
+
+        if table_name is None or seen_ids is None or pipeline_id is None:
+            self.logger.error("delete_missing_rows failed: missing parameters table_name, seen_ids or pipeline_id")
+            return None
+
+        sql = """
+            WITH deleted AS (
+                DELETE FROM gutter_data."{0}" AS t
+                WHERE t.pipeline_id = :pipeline_id 
+                    AND NOT EXISTS (SELECT 1 FROM unnest(CAST(:ids AS text[])) AS seen(id) WHERE seen.id = t.id)
+                RETURNING t.id, t.data, t.last_updated
+            ),
+            history AS (
+                INSERT INTO gutter_data."{0}_history" (row_id, valid_from, valid_to, pipeline_id, data)
+                SELECT id, last_updated, :now, :pipeline_id, data FROM deleted
+                RETURNING row_id
+            )
+            SELECT count(*) FROM deleted
+        """.format(table_name)
+
+        try:
+            return self.db_session.execute(text(sql), {'ids': sorted(str(id) for id in seen_ids),
+                                                       'now': datetime.datetime.now(),
+                                                       'pipeline_id': pipeline_id}).scalar()
+        except Exception as e:
+            self.db_session.rollback()
+            self.logger.error("delete_missing_rows failed for table '{0}': {1}".format(table_name, e))
+            return None
+
+    # ----
+
+    def table_is_empty(self, table_name):
+
+        sql = 'SELECT NOT EXISTS (SELECT 1 FROM gutter_data."{0}")'.format(table_name)
+
+        try:
+            return self.db_session.execute(sql).scalar()
+        except Exception as e:
+            self.db_session.rollback()
+            self.logger.error("table_is_empty failed for table '{0}': {1}".format(table_name, e))
+            return False
+
+    # ----
+
     def get_data_by_id(self, table_name=None, id=None):
 
         if table_name is None or id is None:
@@ -392,7 +727,271 @@ class GutterStore:
     def get_data_list(self, table_name, schema_definition, select=None, filters=[], limit=None, offset=None,
                       order_by=None, order_by_type=None, format=None):
 
-        # get list of data rows
+        # get list of data rows ( without cursor for next page: see get_data_page )
+        data, next_cursor = self.get_data_page(table_name, schema_definition, select=select, filters=filters,
+                                               limit=limit, offset=offset, order_by=order_by,
+                                               order_by_type=order_by_type, format=format)
+
+        return data
+
+    # ----
+
+    def get_data_page(self, table_name, schema_definition, select=None, filters=[], limit=None, offset=None,
+                      order_by=None, order_by_type=None, format=None, after=None, as_text=False):
+
+        """ Get a page of data rows 
+        
+            Next pages can be requested with the returned cursor ( after ): instead of an OFFSET that reads and 
+            skips all earlier rows it seeks to the rows after the last row: WHERE (sort_key, id) > (last_sort_key, last_id)
+            So deep pages cost the same as the first page
+        
+        :param select: list of column names ( can be nested like 'locatie.latitude' ) or None for all data
+        :param after: cursor from earlier page ( see encode_cursor ) with the same order_by
+        :param as_text: return the list as json text made by Postgres ( not for geojson ): see get_data_page_text
+        :return: ( list of dicts or geojson, cursor str or None ) or ( GutterStoreError, None ) --
+        
+        """
+
+        StorageModel = self.get_storage_model(table_name)  # NOTE: this returns a SQLAlchemy ORM class
+
+        query, sort_key, sort_key_type = self.get_data_query(table_name, schema_definition, select=select, filters=filters,
+                                                             order_by=order_by, order_by_type=order_by_type)
+        is_descending = order_by is not None and order_by_type == "desc"
+
+        # cursor: seek to the rows after the last row of the previous page
+        if after is not None:
+            cursor = self.decode_cursor(after)
+
+            if cursor is None or cursor.get('order_by') != order_by or cursor.get('desc') != is_descending:
+                self.logger.error("Invalid cursor '{0}' for order by '{1}'".format(after, order_by))
+                return GutterStoreError(msg="Invalid $after cursor: use it with the same $orderBy", status_code=400), None
+
+            query = query.filter(self.get_cursor_filter(StorageModel, sort_key, sort_key_type, is_descending, cursor))
+
+        # filter parameter: offset 
+        if offset is not None:
+            if isinstance(offset, int):
+                query = query.offset(offset)
+
+        # limit
+        if limit is not None:
+            if isinstance(limit, int):
+                # we can get maximum of GET_MAX_ROWS otherwise get GET_MAX_ROWS_DEFAULT 
+                if limit > self.GET_MAX_ROWS:
+                    limit = self.GET_MAX_ROWS
+                query = query.limit(limit)
+        else:
+            query = query.limit(self.GET_NUM_ROWS_DEFAULT)
+
+        # DEBUG: print sql
+        # print(query.statement.compile(compile_kwargs={"literal_binds": True}))
+        # NOTE: this is not always the right sql _ it seams that there dialects are handled after this step
+
+        if as_text and format != 'geojson':
+            return self.get_data_page_text(query, order_by, is_descending, limit or self.GET_NUM_ROWS_DEFAULT)
+
+        list = query.all()  # returns rows of columns ( see get_data_query )
+
+        # full page: there can be a next page after the last row
+        next_cursor = None
+
+        if len(list) > 0 and len(list) == (limit or self.GET_NUM_ROWS_DEFAULT):
+            last_row = list[-1]
+            next_cursor = self.encode_cursor({'order_by': order_by, 'desc': is_descending, 'id': last_row.id,
+                                              'value': last_row.sort_value if order_by is not None else None})
+
+        list_dicts = [self.get_row_data_dict(r) for r in list]
+
+        # call parameter: format: enable geojson output for gis applications
+        if format == 'geojson':
+            geojson = self.data_to_geo_json(data=list_dicts, schema_definition=schema_definition)
+            return geojson, next_cursor
+        else:
+            # just normal json
+            return list_dicts, next_cursor
+
+    # ----
+
+    def get_data_page_text(self, query, order_by, is_descending, page_size):
+
+        """ Get a page of data rows as json text made by Postgres with json_agg
+        
+            Python never decodes and encodes the rows: the text can be the response body as it is.
+            The output is the same as the list of get_row_data_dict
+        
+        :param query: query of get_data_query with paging
+        :return: ( json text of list, cursor str or None ) --
+        
+        """
+
+        page = query.subquery()
+
+        order = [page.c.sort_value, page.c.id] if order_by is not None else [page.c.id]
+        reverse_order = [desc(column) for column in order]
+
+        if is_descending:
+            order, reverse_order = reverse_order, order
+
+        # _created_at like datetime.isoformat(): the json of a timestamp drops trailing zeros of the microseconds
+        created_at = func.to_char(page.c.created_at, 'YYYY-MM-DD"T"HH24:MI:SS').op('||')(
+            case([(func.to_char(page.c.created_at, 'US') == '000000', '')],
+                 else_=func.to_char(page.c.created_at, '.US')))
+
+        row_json = func.coalesce(page.c.data, literal_column("'{}'::jsonb")).op('||')(
+            func.jsonb_build_object('_id', page.c.id, '_created_at', created_at,
+                                    '_created_by', page.c.created_by))
+
+        columns = [func.count().label('num_rows'),
+                   cast(func.coalesce(func.json_agg(aggregate_order_by(row_json, *order)), literal_column("'[]'::json")), Text).label('rows'),
+                   func.array_agg(aggregate_order_by(page.c.id, *reverse_order))[1].label('last_id')]
+
+        if order_by is not None:
+            columns.append(func.array_agg(aggregate_order_by(page.c.sort_value, *reverse_order))[1].label('last_value'))
+
+        r = self.db_session.query(*columns).one()
+
+        # full page: there can be a next page after the last row
+        next_cursor = None
+
+        if r.num_rows > 0 and r.num_rows == page_size:
+            next_cursor = self.encode_cursor({'order_by': order_by, 'desc': is_descending, 'id': r.last_id,
+                                              'value': r.last_value if order_by is not None else None})
+
+        return r.rows, next_cursor
+
+    # ----
+
+    def iter_data(self, table_name, schema_definition, select=None, filters=[], limit=None, offset=None,
+                  order_by=None, order_by_type=None):
+
+        """ Iterate over data rows without loading them all in memory ( for streaming exports )
+        
+            Rows are read with a server side cursor in batches of STREAM_BATCH_SIZE. 
+            There is no GET_MAX_ROWS cap: without limit all rows are returned
+        
+        :return: generator of dicts --
+        
+        """
+
+        # own session: the rows are read while the response is written and the shared session is used by other requests
+        session = self.db_session_maker()
+
+        try:
+            query, sort_key, sort_key_type = self.get_data_query(table_name, schema_definition, select=select,
+                                                                 filters=filters, order_by=order_by,
+                                                                 order_by_type=order_by_type)
+            query = query.with_session(session)
+
+            if isinstance(offset, int):
+                query = query.offset(offset)
+
+            if isinstance(limit, int):
+                query = query.limit(limit)
+
+            # yield_per: server side cursor ( stream_results ) and no identity map of all rows
+            for row in query.yield_per(self.STREAM_BATCH_SIZE):
+                yield self.get_row_data_dict(row)
+
+        finally:
+            session.close()
+
+    # ----
+
+    def get_data_count(self, table_name, schema_definition, filters=[]):
+
+        """ Get the number of rows that match the filters: exact for selective filters, an estimate for broad ones
+        
+            The planner estimate ( pg_class.reltuples without filters, EXPLAIN with filters ) decides: below 
+            COUNT_EXACT_MAX_ROWS the rows are counted. Counts are cached for COUNT_CACHE_SECONDS and forgotten 
+            when data is written with insert_data, update_data or delete_data
+        
+        :return: ( int, is_exact bool ) or None --
+        
+        """
+
+        cache_key = (table_name, json.dumps(sorted([str(filter.get('column')), str(filter.get('logic')),
+                                                    str(filter.get('value'))] for filter in filters)))
+
+        with COUNT_CACHE_LOCK:
+            cached = COUNT_CACHE.get(cache_key)
+
+        if cached is not None and time.time() - cached[0] < self.COUNT_CACHE_SECONDS:
+            return cached[1], cached[2]
+
+        try:
+            query = self.get_data_query(table_name, schema_definition, filters=filters)[0].order_by(None)
+
+            if len(filters) == 0:
+                estimate = self.db_session.execute(
+                    text("SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table_name AS regclass)"),
+                    {'table_name': 'gutter_data."{0}"'.format(table_name)}).scalar()
+            else:
+                estimate = self.get_query_estimate(query)
+
+            # reltuples is -1 or 0 when the table was never analyzed
+            if estimate is not None and estimate >= self.COUNT_EXACT_MAX_ROWS:
+                count, is_exact = int(estimate), False
+            else:
+                count, is_exact = query.with_entities(func.count(self.get_storage_model(table_name).id)).scalar(), True
+
+        except Exception as e:
+            self.db_session.rollback()
+            self.logger.error("Cannot count rows of table '{0}': {1}".format(table_name, e))
+            return None
+
+        with COUNT_CACHE_LOCK:
+            if len(COUNT_CACHE) >= self.COUNT_CACHE_MAX_SIZE:
+                COUNT_CACHE.clear()
+
+            COUNT_CACHE[cache_key] = (time.time(), count, is_exact)
+
+        return count, is_exact
+
+    # ----
+
+    def get_query_estimate(self, query):
+
+        """ Number of rows of a query as estimated by the Postgres planner ( without running the query )
+        
+        :return: int --
+        
+        """
+
+        statement = query.statement.compile(dialect=self.db_engine.dialect)
+
+        cursor = self.db_session.connection().connection.cursor()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + str(statement), statement.params)
+        plan = cursor.fetchone()[0]
+        cursor.close()
+
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    # ----
+
+    @staticmethod
+    def forget_data_counts(table_name):
+
+        # data of table changed: cached counts are not right anymore
+        with COUNT_CACHE_LOCK:
+            for cache_key in [cache_key for cache_key in COUNT_CACHE.keys() if cache_key[0] == table_name]:
+                del COUNT_CACHE[cache_key]
+
+    # ----
+
+    def get_data_query(self, table_name, schema_definition, select=None, filters=[], order_by=None,
+                       order_by_type=None):
+
+        """ Make the query for data rows with filters and ordering ( see get_data_page and iter_data )
+        
+            The query selects only columns, no ORM rows: id, created_at, created_by, data ( only the $select fields )
+            and sort_value ( value of order_by ). See get_row_data_dict
+        
+        :return: ( SQLAlchemy query, sort_key, sort_key_type ) -- sort_key is None without order_by
+        
+        """
 
         OPERATOR_MAP = {
             'eq': operator.eq,
@@ -471,64 +1070,160 @@ class GutterStore:
                 real_filters.append(entry_logic)
 
         query = self.db_session.query(StorageModel).filter(*real_filters)
-        
 
         # filter parameter: orderBy
+        sort_key = None
+        sort_key_type = None
+        is_descending = order_by is not None and order_by_type == "desc"
+
         if order_by is not None:
             
             # for ordering to work we need to cast
             column_type = self.get_column_type_from_schema_definition(schema_definition, order_by) # number or string
-            
-            if order_by_type is "desc":
-                
-                if column_type == 'number':
-                    query = query.order_by( desc( cast(StorageModel.data[order_by].astext, Numeric)), StorageModel.id) # NOTE: secondary order by id
-                else:
-                    # string
-                    query = query.order_by( desc(StorageModel.data[order_by]), StorageModel.id)
-                
+
+            if column_type == 'number':
+                sort_key = cast(StorageModel.data[order_by].astext, Numeric)
+                sort_key_type = Numeric
             else:
-                # ascending order
-                if column_type == 'number':
-                    query = query.order_by( cast(StorageModel.data[order_by].astext, Numeric), StorageModel.id) # NOTE: secondary order by id
-                else:
-                    # string
-                    query = query.order_by( StorageModel.data[order_by], StorageModel.id)                
+                # string: as text so json null and missing values are both NULL ( needed for the cursor )
+                sort_key = StorageModel.data[order_by].astext
+                sort_key_type = String
+
+            # NOTE: secondary order by id in the same direction: needed for the cursor
+            if is_descending:
+                query = query.order_by(desc(sort_key), desc(StorageModel.id))
+            else:
+                query = query.order_by(sort_key, StorageModel.id)
 
         else:
             # basic ordering by id
             # IMPORTANT: otherwise iterating over large sets give inconsistent results
             query = query.order_by(StorageModel.id)
-                
-        # filter parameter: offset 
-        if offset is not None:
-            if isinstance(offset, int):
-                query = query.offset(offset)
 
-        # limit
-        if limit is not None:
-            if isinstance(limit, int):
-                # we can get maximum of GET_MAX_ROWS otherwise get GET_MAX_ROWS_DEFAULT 
-                if limit > self.GET_MAX_ROWS:
-                    limit = self.GET_MAX_ROWS
-                query = query.limit(limit)
-        else:
-            query = query.limit(self.GET_NUM_ROWS_DEFAULT)
+        # only the columns we output
+        columns = [StorageModel.id, StorageModel.created_at, StorageModel.created_by,
+                   self.get_select_data(StorageModel, schema_definition, select).label('data')]
 
-        # DEBUG: print sql
-        # print(query.statement.compile(compile_kwargs={"literal_binds": True}))
-        # NOTE: this is not always the right sql _ it seams that there dialects are handled after this step
+        if sort_key is not None:
+            columns.append(sort_key.label('sort_value'))
 
-        list = query.all()  # returns objects
-        list_dicts = [r.get_data_dict() for r in list]
+        query = query.with_entities(*columns)
 
-        # call parameter: format: enable geojson output for gis applications
-        if format == 'geojson':
-            geojson = self.data_to_geo_json(data=list_dicts, schema_definition=schema_definition)
-            return geojson
-        else:
-            # just normal json
-            return list_dicts
+        return query, sort_key, sort_key_type
+
+    # ----
+
+    def get_select_data(self, StorageModel, schema_definition, select=None):
+
+        """ Expression of the data with only the selected fields: made in Postgres with jsonb_build_object
+            Nested fields give nested objects: [ 'naam', 'locatie.latitude' ] gives { naam, locatie : { latitude } }
+        
+        :param select: list of column names or None
+        :return: SQLAlchemy expression -- the whole data without ( valid ) select
+        
+        """
+
+        # tree of selected paths: key : None ( whole value ) or dict of selected sub fields
+        tree = {}
+
+        for column_name in select or []:
+            if not self.schema_definition_has_column(schema_definition, column_name):
+                self.logger.error("Skipped column name '{0}' in $select".format(column_name))
+                continue
+
+            keys = column_name.split('.')
+            level = tree
+
+            for key in keys[:-1]:
+                if key in level and level[key] is None:
+                    level = None  # parent is already selected as a whole
+                    break
+
+                level = level.setdefault(key, {})
+
+            if level is not None:
+                level[keys[-1]] = None
+
+        if len(tree) == 0:
+            return StorageModel.data
+
+        def build_object(level, path):
+            args = []
+
+            for key, sub_level in level.items():
+                args.append(literal(key, type_=String))
+                args.append(StorageModel.data[tuple(path + [key])] if sub_level is None
+                            else build_object(sub_level, path + [key]))
+
+            return func.jsonb_build_object(*args)
+
+        return build_object(tree, [])
+
+    # ----
+
+    @staticmethod
+    def get_row_data_dict(row):
+
+        # output of a row of get_data_query: like StorageRow.get_data_dict
+        d = row.data if row.data is not None else {}
+        d['_id'] = row.id
+        d['_created_at'] = row.created_at.isoformat()
+        d['_created_by'] = row.created_by
+
+        return d
+
+    # ----
+
+    def get_cursor_filter(self, StorageModel, sort_key, sort_key_type, is_descending, cursor):
+
+        """ Filter for the rows after the cursor row in the order of get_data_page
+            NOTE: Postgres sorts NULL as the biggest value: last in ascending and first in descending order
+        
+        :return: SQLAlchemy filter expression --
+        
+        """
+
+        last_id = str(cursor.get('id'))
+
+        if sort_key is None:
+            return StorageModel.id > last_id
+
+        last_value = cursor.get('value')
+
+        if last_value is None:
+            # within the rows without sort value
+            if is_descending:
+                return or_(and_(sort_key.is_(None), StorageModel.id < last_id), sort_key.isnot(None))
+
+            return and_(sort_key.is_(None), StorageModel.id > last_id)
+
+        last_row = tuple_(literal(last_value, type_=sort_key_type), literal(last_id))
+
+        if is_descending:
+            return tuple_(sort_key, StorageModel.id) < last_row
+
+        return or_(tuple_(sort_key, StorageModel.id) > last_row, sort_key.is_(None))
+
+    # ----
+
+    @staticmethod
+    def encode_cursor(cursor):
+
+        # opaque token for clients: url safe base64 of json
+        return base64.urlsafe_b64encode(json.dumps(cursor, default=str).encode('utf8')).decode('ascii').rstrip('=')
+
+    # ----
+
+    @staticmethod
+    def decode_cursor(token):
+
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf8'),
+                                use_decimal=True)  # exact numeric sort values
+        except Exception:
+            return None
+
+        return cursor if isinstance(cursor, dict) and cursor.get('id') is not None else None
 
     # ----
 
@@ -557,6 +1252,7 @@ class GutterStore:
         new_storage_row = StorageModel(id=id, created_by=user, created_at=data.get('created_at'), last_checked=None, last_updated=None, pipeline_id=None, data=data)
         self.add_rows([new_storage_row])
         self.commit()
+        self.forget_data_counts(table_name)
 
         # return new row instance
         return new_storage_row
@@ -583,7 +1279,9 @@ class GutterStore:
             return None
 
         existing_storage_row.data = data  # save new data
+        existing_storage_row.datahash = self.get_data_hash(data)
         self.db_session.commit()
+        self.forget_data_counts(table_name)
 
         # return updated row
         return existing_storage_row
@@ -606,6 +1304,7 @@ class GutterStore:
         try:
             self.db_session.delete(existing_storage_row)
             self.db_session.commit()
+            self.forget_data_counts(table_name)
 
             return True
 
@@ -915,11 +1614,9 @@ class GutterStore:
             self.logger.error("make_sqls_for_indices: Please supply table_name and properties!")
             return []
 
-        sqls = []
-
         for property_name, property_def in properties.items():
 
-            index_name = "gutter_" + table_name + '_' + '_'.join(parent_names) + "_" + property_name + "_idx"
+            index_name = self.get_index_name(table_name, '_'.join(parent_names) + "_" + property_name)
 
             # Index on a JSONB field : 
             # create index if not exists locatie_idx on waarnemingen_real using btree ( cast( (data#>>'{locatie,latitude}') as numeric) )
@@ -937,27 +1634,27 @@ class GutterStore:
             # !!!! IMPORTANT: GUTTER_TO_TIMESTAMP !!!!
             # check and make that function on database
 
-            if property_def.get('type') == 'string' and property_def.get('format') == 'date_time':
+            if property_def.get('type') == 'string' and property_def.get('format') in ['date-time', 'date_time']:
                 # NOTE: on time zones: http://blog.untrod.com/2016/08/actually_understanding_timezones_in_postgresql.html 
                 # UTC+2
                 if primary_field:
                     sqls.append(
-                        "CREATE INDEX IF NOT EXISTS {0} ON {1} USING BTREE ( GUTTER_TO_TIMESTAMP(data->>'{2}') )".format(
+                        "CREATE INDEX IF NOT EXISTS \"{0}\" ON gutter_data.\"{1}\" USING BTREE ( GUTTER_TO_TIMESTAMP(data->>'{2}') )".format(
                             index_name, table_name, property_name));
                 else:
                     sqls.append(
-                        "CREATE INDEX IF NOT EXISTS {0} ON {1} USING BTREE ( GUTTER_TO_TIMESTAMP(data#>>'{2}') )".format(
+                        "CREATE INDEX IF NOT EXISTS \"{0}\" ON gutter_data.\"{1}\" USING BTREE ( GUTTER_TO_TIMESTAMP(data#>>'{2}') )".format(
                             index_name, table_name, json_path));
 
             elif property_def.get('type') == 'number':
 
                 if primary_field:
                     sqls.append(
-                        "CREATE INDEX IF NOT EXISTS {0} ON {1} USING BTREE ( cast(data->>'{2}' as numeric ) )".format(
+                        "CREATE INDEX IF NOT EXISTS \"{0}\" ON gutter_data.\"{1}\" USING BTREE ( cast(data->>'{2}' as numeric ) )".format(
                             index_name, table_name, property_name));
                 else:
                     sqls.append(
-                        "CREATE INDEX IF NOT EXISTS {0} ON {1} USING BTREE ( cast(data#>>'{2}' as numeric) )".format(
+                        "CREATE INDEX IF NOT EXISTS \"{0}\" ON gutter_data.\"{1}\" USING BTREE ( cast(data#>>'{2}' as numeric) )".format(
                             index_name, table_name, json_path));
 
             elif property_def.get('type') == 'object':
@@ -969,12 +1666,12 @@ class GutterStore:
             else:  # string
                 if primary_field:
                     sqls.append(
-                        "CREATE INDEX IF NOT EXISTS {0} on {1} USING BTREE ( (data_>>'{2}') )".format(index_name,
+                        "CREATE INDEX IF NOT EXISTS \"{0}\" on gutter_data.\"{1}\" USING BTREE ( (data->>'{2}') )".format(index_name,
                                                                                                       table_name,
                                                                                                       property_name));
                 else:
                     sqls.append(
-                        "CREATE INDEX IF NOT EXISTS {0} on {1} USING BTREE ( (data#>>'{2}') )".format(index_name,
+                        "CREATE INDEX IF NOT EXISTS \"{0}\" on gutter_data.\"{1}\" USING BTREE ( (data#>>'{2}') )".format(index_name,
                                                                                                       table_name,
                                                                                                       json_path));
 
@@ -988,28 +1685,75 @@ class GutterStore:
 
         # ----
 
-    def drop_indices(self, table_name, schema_definition):
+    def drop_indices(self, table_name, schema_definition=None):
 
-        if table_name is None or schema_definition is None:
-            self.logger.error("Create_indices failed: missing parameters table_name or schema_definition")
-            return False
+        # NOTE: we look up the indices made by create_indices ( also of nested fields ) by name in the database
+        # the index on (id, datahash) is part of the storage table and stays
 
-        sqls = []
+        if table_name is None:
+            self.logger.error("drop_indices failed: missing parameter table_name")
+            return False
 
-        for property_name, property_def in schema_definition['properties'].iteritems():
-            index_name = "gutter_" + table_name + "_" + property_name + "_idx"
+        sql = """SELECT indexname FROM pg_indexes 
+                 WHERE schemaname = 'gutter_data' AND tablename = :table_name 
+                 AND indexname LIKE :pattern AND indexname <> :keep"""
 
-            sqls.append("DROP INDEX IF EXISTS {0}".format(index_name, table_name, property_name));
+        try:
+            index_names = [r[0] for r in self.db_session.execute(text(sql), {
+                'table_name': table_name,
+                'pattern': self.get_index_name_prefix(table_name).replace('_', '\\_') + '%\\_idx',
+                'keep': self.get_index_name(table_name, 'id_datahash')}).fetchall()]
 
-        sql = ";\n".join(sqls)
+            for index_name in index_names:
+                self.db_session.execute('DROP INDEX IF EXISTS gutter_data."{0}"'.format(index_name))
 
-        try:
-            r = self.db_session.execute(sql)
             self.db_session.commit()
         except Exception as e:
+            self.db_session.rollback()
             self.logger.error(e)
+            return False
 
-            # ----
+        return True
+
+    # ----
+
+    @staticmethod
+    def get_index_name_prefix(table_name):
+
+        # start of the names of all indices of a table ( see get_index_name and drop_indices )
+        prefix = 'gutter_' + table_name + '_'
+
+        if len(prefix) > 40:
+            # long table name: shortened with a hash to keep it unique
+            prefix = 'gutter_' + table_name[:24] + '_' + hashlib.md5(table_name.encode('utf8')).hexdigest()[:8] + '_'
+
+        return prefix
+
+    # ----
+
+    @staticmethod
+    def get_index_name(table_name, field_name):
+
+        """ Name of the index of a data field
+        
+            NOTE: Postgres cuts names at 63 characters: longer names are shortened with a hash here, 
+            so the same name is made every time and drop_indices can find it. Use it quoted: it keeps its case
+        
+        :param field_name: name of field ( nested fields joined with '_' )
+        :return: str --
+        
+        """
+
+        prefix = GutterStore.get_index_name_prefix(table_name)
+        index_name = prefix + field_name + '_idx'
+
+        if len(index_name) > 63:
+            index_name = prefix + field_name[:63 - len(prefix) - 13] + '_' + \
+                         hashlib.md5(field_name.encode('utf8')).hexdigest()[:8] + '_idx'
+
+        return index_name
+
+    # ----
 
     def create_data_view(self, table_name=None, schema_definition=None):
 
@@ -0,0 +1,83 @@
+"""
+
+    ModelRegistry.py
+
+    * Keeps the dynamic ORM model classes of gutter tables ( storage and history rows ) so they are made once
+    * Every model has its own MetaData: making the model of one table never touches another
+    * Bounded: the least recently used models are evicted when there are more than max_size
+    * Thread safe: a model is made once, also when many requests or workers ask for it at the same time
+
+"""
+
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import MetaData
+
+from collections import OrderedDict
+import threading
+import logging
+
+
+class ModelRegistry:
+
+    def __init__(self, max_size=256):
+
+        """
+        :param max_size: maximum number of model classes kept
+
+        """
+
+        # settings
+        self.max_size = max_size
+
+        # properties
+        self.models = OrderedDict()  # ( kind, table_name ) : model class, least recently used first
+        self.lock = threading.RLock()
+
+        self.logger = logging.getLogger(__name__)
+
+    # ----
+
+    def get_model(self, table_name, kind, make_model):
+
+        """ Get the model class of a table or make it
+
+        :param table_name: Name of gutter table
+        :param kind: kind of model, like 'storage' or 'history'
+        :param make_model: function( table_name, Base ) that returns a new model class on given declarative base
+        :return: SQLAlchemy ORM class --
+
+        """
+
+        key = (kind, table_name)
+
+        with self.lock:
+            model = self.models.get(key)
+
+            if model is not None:
+                self.models.move_to_end(key)
+                return model
+
+            # own base and metadata for every model
+            Base = declarative_base(metadata=MetaData())
+            model = make_model(table_name, Base)
+
+            self.models[key] = model
+
+            while len(self.models) > self.max_size:
+                evicted_key, _ = self.models.popitem(last=False)
+                self.logger.info("Evicted {0} model of table '{1}'".format(*evicted_key))
+
+            return model
+
+    # ----
+
+    def clear(self):
+
+        with self.lock:
+            self.models.clear()
+
+    # ----
+
+    def __len__(self):
+
+        return len(self.models)
@@ -1,22 +1,50 @@
 """
     ApiSource.py - sources an Rest API for data 
     
+    * Pages ( URLs with {{BATCH_NUM}} ) are prefetched concurrently: set data_source['concurrency'] ( default 1 )
+    * Requests go over one keep-alive session with retries and gzip. With use_page_validators pages are 
+      requested conditionally ( If-None-Match / If-Modified-Since ): a 304 gives an UnchangedPage
+    * With data_source['stream_rows'] the rows are parsed from the response while it comes in ( needs ijson ):
+      for big exports that don't fit in memory at once
+    * The schema is inferred from a sample of rows and cached per URL ( data_source['schema_cache_seconds'] )
+    
 """
 
+import concurrent.futures
+import collections
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 import requests
+import threading
 import logging
+import copy
+import time
 import re
 import simplejson as json
 
 import string
 import random
 
+try:
+    import ijson  # optional: only needed for streaming rows
+except ImportError:
+    ijson = None
+
+from .UnchangedPage import UnchangedPage
+
 # Some Python2 backwards compatibility already
 from future.standard_library import install_aliases
 
 install_aliases()
 from urllib.parse import urlparse, parse_qsl
 
+DATE_TIME_RE = re.compile(r'^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}')
+
+# inferred schema properties by source: ( url, rows_root ) : ( time, properties )
+SCHEMA_CACHE = {}
+SCHEMA_CACHE_LOCK = threading.Lock()
+
 
 class ApiSource:
 
@@ -32,10 +60,23 @@ class ApiSource:
         """ Initiate a ApiSource
         
         :param source_obj: Dict with { get_token: "<<ID>>: example: sia", 
-                url, token, rows_root:  root of row data in response json }
+                url, token, rows_root:  root of row data in response json, 
+                concurrency: number of pages fetched at the same time, timeout: seconds for a request,
+                stream_rows: parse rows from the response stream, 
+                schema_sample_rows: number of rows to infer the schema from, 
+                schema_cache_seconds: keep inferred schema this long }
                 
         """
 
+        self.concurrency = 1
+        self.timeout = 30
+        self.retries = 3  # for connection errors and 429 and 5xx responses, with exponential backoff
+        self.retry_backoff = 0.5
+        self.stream_rows = False
+        self.schema_sample_rows = 100
+        self.schema_sample_pages = 3  # at most this number of pages is fetched for the sample
+        self.schema_cache_seconds = 3600
+
         if isinstance(source_obj, dict):
             self.base_url = source_obj.get('url')  # URL can contain template placholders {{BATCH_NUM_PLUS_ONE}}
             self.cur_url = None  # filled URL
@@ -50,8 +91,38 @@ class ApiSource:
             self.inlog_curl = source_obj.get('inlog_curl')
             self.inlog_curl_token_re = source_obj.get('inlog_curl_token_re')
 
+            self.concurrency = max(1, int(source_obj.get('concurrency') or self.concurrency))
+            self.timeout = source_obj.get('timeout') or self.timeout
+            self.retries = int(source_obj.get('retries', self.retries))
+            self.stream_rows = bool(source_obj.get('stream_rows'))
+            self.schema_sample_rows = int(source_obj.get('schema_sample_rows') or self.schema_sample_rows)
+            self.schema_cache_seconds = source_obj.get('schema_cache_seconds', self.schema_cache_seconds)
+
+            if self.stream_rows and ijson is None:
+                logging.getLogger(__name__).error("Streaming rows needs the ijson package: read whole responses")
+                self.stream_rows = False
+
         self.url_variables = {'BATCH_NUM': 1}  # TODO: add batch_num, batch_start, batch_end, etc.
 
+        # conditional requests: validators of pages of last run and of this run ( saved by GutterFlow on success )
+        self.use_page_validators = False
+        self.page_validators = {}  # url : { etag, last_modified, num_rows }
+        self.new_page_validators = {}
+
+        # failed requests: a read that stopped on an error must not look like the end of the source
+        self.failed_urls = {}  # url : error of last request of that url
+        self.fetch_errors = []  # ( url, error ) of failed requests that ended a read ( see iter_batches )
+
+        # one session for all requests: connections are kept alive and shared by the fetching threads
+        retry = Retry(total=self.retries, backoff_factor=self.retry_backoff, status_forcelist=[429, 500, 502, 503, 504],
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_maxsize=self.concurrency, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
         self.setup_logger()
 
     # ----
@@ -77,16 +148,22 @@ class ApiSource:
 
     # ----
 
-    def get_token(self):
+    def close(self):
 
-        self.logger.info("Get token for API '{0}'".format(self.cur_url))
+        # close the pooled connections of the session ( the source is made again for every run )
+        self.session.close()
+
+    # ----
+
+    def get_token(self):
 
         if self.token is not None:
-            # just return plane token
+            # just return plane token: we only log in once per source
             return self.token
 
         # we have special function to get token
         if self.get_special_token is not None:
+            self.logger.info("Get token for API '{0}'".format(self.base_url))
 
             if self.get_special_token == "SIA":
                 # set token direct in instance
@@ -96,11 +173,13 @@ class ApiSource:
 
     # ----
 
-    def get_rows(self, url=None):
+    def get_rows(self, url=None, conditional=False):
 
         """ Get rows from API call
         
-        return: list of dict --
+        :param url: default filled base url
+        :param conditional: only get the rows when the page changed since last run 
+        return: list of dict or UnchangedPage --
         
         """
 
@@ -118,21 +197,50 @@ class ApiSource:
         if self.token:
             headers = {"Authorization": "Bearer {0}".format(self.token)}
 
+        validators = self.page_validators.get(url) if conditional else None
+
+        if validators is not None:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+        self.failed_urls.pop(url, None)
+
         try:
-            data = requests.get(url, data={}, headers=headers).json()
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+
+            if response.status_code == 304 and validators is not None:
+                self.new_page_validators[url] = validators
+                return UnchangedPage(url, validators.get('num_rows') or 0)
+
+            if response.status_code == 404:
+                # page after the last page: no rows
+                self.logger.info("No page for url '{0}' ( 404 )".format(url))
+                return []
+
+            response.raise_for_status()
+            data = response.json()
         except Exception as e:
-            self.logger.error("Cannot get data from API")
+            self.logger.error("Cannot get data from API for url '{0}': {1}".format(url, e))
+            self.failed_urls[url] = str(e)
             return []
 
         if self.rows_root is not None:
-            rows = data.get(self.rows_root)
+            rows = data.get(self.rows_root) if isinstance(data, dict) else None
         else:
             rows = data
 
         if data is None or rows is None:
             self.logger.error("get_rows: No rows found for url: '{0}'".format(url))
+            self.failed_urls[url] = "no rows in '{0}'".format(self.rows_root)
             return []
 
+        if response.headers.get('ETag') or response.headers.get('Last-Modified'):
+            self.new_page_validators[url] = {'etag': response.headers.get('ETag'),
+                                             'last_modified': response.headers.get('Last-Modified'),
+                                             'num_rows': len(rows)}
+
         return rows
 
     # ----
@@ -164,14 +272,22 @@ class ApiSource:
 
     def get_schema_definition(self, title=None):
 
-        """ Simply get first first row, then make into json schema definition
-        
-        TODO: maybe check out more rows to figure out more data types
+        """ Make a json schema definition from a sample of rows ( see get_schema_properties )
+            The properties are cached by URL: pipeline runs within schema_cache_seconds don't fetch a sample again
         
+        :return: dict { title, properties } -- empty dict when there are no rows
         
         """
 
-        rows = self.get_batch_rows(0)
+        cache_key = (self.base_url, self.rows_root)
+
+        with SCHEMA_CACHE_LOCK:
+            cached = SCHEMA_CACHE.get(cache_key)
+
+        if cached is not None and time.time() - cached[0] < (self.schema_cache_seconds or 0):
+            return {'title': title or self.base_url, 'properties': copy.deepcopy(cached[1])}
+
+        rows = self.get_sample_rows()
 
         if not isinstance(rows, list):
             self.logger.error("No test data to make schema definition!")
@@ -183,70 +299,299 @@ class ApiSource:
                     self.token))
             return {}
 
-        first_row = rows[0]
+        properties = self.get_schema_properties(rows)
+
+        with SCHEMA_CACHE_LOCK:
+            SCHEMA_CACHE[cache_key] = (time.time(), properties)
+
+        self.logger.info("Inferred schema of '{0}' from {1} rows".format(self.base_url, len(rows)))
 
         return {
             'title': title or self.base_url,
-            'properties': self.get_schema_properties_for_dict(first_row)
+            'properties': copy.deepcopy(properties)
         }
 
     # ----
 
-    def get_schema_properties_for_dict(self, d):
+    def get_sample_rows(self):
 
-        MAP_PYTHON_OBJECTS_TO_JSON_SCHEMA_OBJS = {
-            'unicode': 'string',
-            'str': 'string',
-            'dict': 'object',
-            'int': 'integer',
-            'float': 'number',
-            'long': 'number',
-            'NoneType': 'string',
-            'bool': 'boolean',
-            'list': 'array'}
-
-        FORMAT_TESTS_RE = {
-            '[\d]{4}-[\d]{2}-[\d]{2}T| [\d]{2}\:[\d]{2}\:[\d]{2}\.[\d]{6}Z': 'date-time',
-            '[\d]{4}-[\d]{2}-[\d]{2}T| [\d]{2}\:[\d]{2}\:[\d]{2}': 'date-time'
-        }
+        """ Get the first schema_sample_rows rows ( from at most schema_sample_pages pages )
+        
+        :return: list of dicts --
+        
+        """
 
-        properties = {}
+        if self.stream_rows:
+            # don't load a whole export for a sample
+            batches = self.iter_streamed_batches(batch_size=self.schema_sample_rows)
+            rows = next(batches, [])
+            batches.close()
 
-        for key, value in d.items():
+            return rows
 
-            python_value_type = re.findall("\'([^\']+)\'", str(type(value)))[0]
+        rows = []
 
-            json_type = MAP_PYTHON_OBJECTS_TO_JSON_SCHEMA_OBJS.get(python_value_type)
+        for num in range(self.schema_sample_pages):
+            page_rows = self.get_batch_rows(num)
 
-            if json_type == 'object':
-                nested_props = self.get_schema_properties_for_dict(value)
+            if not isinstance(page_rows, list) or len(page_rows) == 0:
+                break
+
+            rows += page_rows
+
+            if len(rows) >= self.schema_sample_rows or not self.is_paged():
+                break
+
+        return rows[:self.schema_sample_rows]
+
+    # ----
+
+    def get_schema_properties(self, rows):
+
+        """ Infer json schema properties from all given rows
+            
+            - null values and missing keys don't decide the type ( properties are nullable )
+            - integer and number together is number, other mixed types are string
+            - properties of nested objects are merged over all rows
+            - format date-time only when all values are date times
+        
+        :param rows: list of dicts
+        :return: dict -- { property_name : { type, format, properties } }
+        
+        """
+
+        seen = collections.OrderedDict()  # property_name : { types, all_date_time, objects }
+
+        for row in rows:
+            if not isinstance(row, dict):
+                continue
+
+            for key, value in row.items():
+                property_seen = seen.setdefault(key, {'types': set(), 'all_date_time': True, 'objects': []})
 
-                properties[key] = {'type': json_type, 'properties': nested_props}
+                if value is None:
+                    continue
 
+                json_type = self.get_json_type(value)
+                property_seen['types'].add(json_type)
+
+                if json_type == 'object':
+                    property_seen['objects'].append(value)
+
+                if json_type != 'string' or not DATE_TIME_RE.match(value):
+                    property_seen['all_date_time'] = False
+
+        properties = {}
+
+        for key, property_seen in seen.items():
+            json_type = self.merge_json_types(property_seen['types'])
+
+            if json_type == 'object':
+                properties[key] = {'type': json_type, 'properties': self.get_schema_properties(property_seen['objects'])}
             else:
                 properties[key] = {'type': json_type}
 
-            # format
-            for t in FORMAT_TESTS_RE:
-                if re.match(t, str(value)):
-                    properties[key]['format'] = FORMAT_TESTS_RE[t]
-                    break
+            if json_type == 'string' and len(property_seen['types']) > 0 and property_seen['all_date_time']:
+                properties[key]['format'] = 'date-time'
 
         return properties
 
     # ----
 
-    def get_batch_rows(self, num):
+    def get_schema_properties_for_dict(self, d):
+
+        return self.get_schema_properties([d])
+
+    # ----
+
+    @staticmethod
+    def get_json_type(value):
+
+        # NOTE: bool is an int in python
+        if isinstance(value, bool):
+            return 'boolean'
+        elif isinstance(value, int):
+            return 'integer'
+        elif isinstance(value, float):
+            return 'number'
+        elif isinstance(value, dict):
+            return 'object'
+        elif isinstance(value, list):
+            return 'array'
+
+        return 'string'
+
+    # ----
+
+    @staticmethod
+    def merge_json_types(json_types):
 
-        url_variables = self.get_placeholders_with_values(num)
-        url = self.fill_url_variables(self.base_url, url_variables)
+        if len(json_types) == 0:
+            return 'string'  # only nulls
+        elif len(json_types) == 1:
+            return next(iter(json_types))
+        elif json_types <= {'integer', 'number'}:
+            return 'number'
 
-        rows = self.get_rows(url)
+        return 'string'
+
+    # ----
+
+    def is_paged(self):
+
+        # URL with placeholders like {{BATCH_NUM}}
+        return len(re.findall('{{[^}]+}}', self.base_url or '')) > 0
+
+    # ----
+
+    def get_batch_url(self, num):
+
+        return self.fill_url_variables(self.base_url, self.get_placeholders_with_values(num))
+
+    # ----
+
+    def get_batch_rows(self, num, conditional=False):
+
+        rows = self.get_rows(self.get_batch_url(num), conditional)
 
         return rows
 
     # ----
 
+    def has_fetch_errors(self):
+
+        # True when a read stopped because a request failed: the rows of the source are not complete
+        return len(self.fetch_errors) > 0
+
+    # ----
+
+    def iter_batches(self, start=0):
+
+        """ Generator of the rows of all pages in page order until the first empty page
+        
+            While a page is being synced the next pages ( as many as concurrency ) are already fetched 
+            in a pool of threads. Pages after the first empty page are fetched but thrown away.
+            When the empty page is a failed request it is added to fetch_errors
+        
+        :param start: number of first page
+        :return: generator of lists of dicts or UnchangedPage --
+        
+        """
+
+        self.get_token()  # once before the threads need it
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency,
+                                                         thread_name_prefix='gutter_api_fetch')
+        pending = collections.deque()  # ( page number, future ) in page order
+        next_num = start
+
+        try:
+            while True:
+                # keep the pool busy: current page and prefetched pages
+                while len(pending) < self.concurrency + 1:
+                    pending.append((next_num, executor.submit(self.get_batch_rows, next_num, self.use_page_validators)))
+                    next_num += 1
+
+                num, future = pending.popleft()
+                rows = future.result()
+
+                if rows is None or len(rows) == 0:
+                    url = self.get_batch_url(num)
+
+                    if url in self.failed_urls:
+                        self.fetch_errors.append((url, self.failed_urls[url]))
+
+                    return
+
+                yield rows
+        finally:
+            # also when the consumer stops early
+            for num, future in pending:
+                future.cancel()
+
+            executor.shutdown(wait=False)
+
+    # ----
+
+    def iter_streamed_batches(self, batch_size=50, start=0):
+
+        """ Generator of batches of rows that are parsed while the responses come in
+            
+            Only one batch of rows is in memory at a time, whatever the size of the response. 
+            Pages are read one after the other until the first empty page. A URL without placeholders 
+            is read once
+        
+        :param batch_size: number of rows in a batch
+        :param start: number of first page
+        :return: generator of lists of dicts --
+        
+        """
+
+        self.get_token()
+
+        is_paged = self.is_paged()
+        page_num = start
+
+        while True:
+            url = self.fill_url_variables(self.base_url, self.get_placeholders_with_values(page_num))
+            num_rows = 0
+
+            for rows in self.get_streamed_rows(url, batch_size):
+                num_rows += len(rows)
+                yield rows
+
+            if num_rows == 0 or not is_paged or self.has_fetch_errors():
+                return
+
+            page_num += 1
+
+    # ----
+
+    def get_streamed_rows(self, url, batch_size=50):
+
+        """ Parse the rows in rows_root of the response of url one by one ( with ijson )
+            An error halfway ( dropped connection, bad JSON, HTTP error ) ends the rows and is added to fetch_errors:
+            the rows of the source are not complete ( see GutterFlow.source_read_is_complete )
+        
+        :return: generator of lists of dicts --
+        
+        """
+
+        headers = {}
+        if self.token:
+            headers = {"Authorization": "Bearer {0}".format(self.token)}
+
+        # rows in rows_root or the response is a list of rows
+        prefix = '{0}.item'.format(self.rows_root) if self.rows_root is not None else 'item'
+
+        try:
+            with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+                if response.status_code == 404:
+                    # page after the last page: no rows
+                    self.logger.info("No page for url '{0}' ( 404 )".format(url))
+                    return
+
+                response.raise_for_status()
+                response.raw.decode_content = True  # gzip
+
+                rows = []
+
+                for row in ijson.items(response.raw, prefix, use_float=True):
+                    rows.append(row)
+
+                    if len(rows) == batch_size:
+                        yield rows
+                        rows = []
+
+                if len(rows) > 0:
+                    yield rows
+
+        except Exception as e:
+            self.logger.error("Cannot stream data from API for url '{0}': {1}".format(url, e))
+            self.fetch_errors.append((url, str(e)))
+
+    # ----
+
     def get_sia_token(self, email, password):
 
         """ Get a SIA token with some random magic ( just pasted from SIA repo ) 
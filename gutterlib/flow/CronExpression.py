@@ -0,0 +1,126 @@
+"""
+
+    CronExpression.py
+
+    * Parses cron expressions with 5 fields: minute hour day_of_month month day_of_week
+    * Supports *, numbers, ranges ( 1-5 ), steps ( */15, 0-30/10 ) and lists ( 1,15,30 )
+    * Day of week is 0-6 with 0 ( or 7 ) as sunday
+
+"""
+
+import datetime
+
+CRON_FIELDS = [('minute', 0, 59), ('hour', 0, 23), ('day_of_month', 1, 31), ('month', 1, 12), ('day_of_week', 0, 7)]
+
+
+class CronExpression:
+
+    def __init__(self, expression):
+
+        """
+        :param expression: cron expression like '*/15 6-18 * * 1-5'
+        :raises ValueError: when the expression is not valid
+
+        """
+
+        self.expression = expression
+
+        fields = expression.split()
+
+        if len(fields) != 5:
+            raise ValueError("Cron expression '{0}' needs 5 fields".format(expression))
+
+        self.values = {}
+
+        for field, (name, minimum, maximum) in zip(fields, CRON_FIELDS):
+            self.values[name] = self.parse_field(field, minimum, maximum)
+
+        # sunday can be 0 or 7
+        if 7 in self.values['day_of_week']:
+            self.values['day_of_week'] = (self.values['day_of_week'] - {7}) | {0}
+
+        # standard cron: when both days are restricted one of them needs to match
+        self.any_day_of_month = fields[2] == '*'
+        self.any_day_of_week = fields[4] == '*'
+
+    # ----
+
+    def __repr__(self):
+
+        return "<CronExpression '{0}'>".format(self.expression)
+
+    # ----
+
+    def parse_field(self, field, minimum, maximum):
+
+        values = set()
+
+        for part in field.split(','):
+            step = 1
+
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+
+                if step < 1:
+                    raise ValueError("Invalid step in cron field '{0}'".format(field))
+
+            if part == '*':
+                start, end = minimum, maximum
+            elif '-' in part:
+                start, end = [int(value) for value in part.split('-')]
+            else:
+                start = int(part)
+                end = maximum if step > 1 else start  # 5/10 means from 5 every 10
+
+            if start < minimum or end > maximum or start > end:
+                raise ValueError("Cron field '{0}' out of range {1}-{2}".format(field, minimum, maximum))
+
+            values.update(range(start, end + 1, step))
+
+        return values
+
+    # ----
+
+    def matches_day(self, dt):
+
+        day_of_month = dt.day in self.values['day_of_month']
+        day_of_week = (dt.isoweekday() % 7) in self.values['day_of_week']  # sunday is 0
+
+        if self.any_day_of_month and self.any_day_of_week:
+            return True
+        elif self.any_day_of_month:
+            return day_of_week
+        elif self.any_day_of_week:
+            return day_of_month
+
+        return day_of_month or day_of_week
+
+    # ----
+
+    def get_next(self, after):
+
+        """ Get the first time after given time that matches the expression
+
+        :param after: datetime
+        :return: datetime or None -- None when nothing matches within 5 years ( like 30 february )
+
+        """
+
+        dt = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = after + datetime.timedelta(days=366 * 5)
+
+        # skip whole months, days and hours that don't match
+        while dt <= limit:
+            if dt.month not in self.values['month']:
+                dt = (dt.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self.matches_day(dt):
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif dt.hour not in self.values['hour']:
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+            elif dt.minute not in self.values['minute']:
+                dt = dt + datetime.timedelta(minutes=1)
+            else:
+                return dt
+
+        return None
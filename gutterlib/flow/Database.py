@@ -4,6 +4,7 @@
     @author: mark
 """
 
+import threading
 import logging
 import os
 
@@ -12,6 +13,10 @@ from sqlalchemy import inspect
 
 from .Table import Table
 
+# engines by connection string: shared by all Database instances ( and pipeline runs ) of this process
+ENGINES = {}
+ENGINES_LOCK = threading.Lock()
+
 
 class Database:
 
@@ -52,12 +57,29 @@ class Database:
     # ----
 
     def __del__(self):
-        # cleanup all connections
-        if self.engine:
-            try:
-                self.engine.dispose()
-            except Exception as e:
-                pass
+        # NOTE: the engine is shared ( see get_engine ): its connection pool stays for the next instance
+        self.engine = None
+
+    # ----
+
+    @staticmethod
+    def get_engine(connection_string):
+
+        """ Get the engine for a connection string: made once per process and then reused
+        
+        :return: SQLAlchemy engine --
+        
+        """
+
+        with ENGINES_LOCK:
+            engine = ENGINES.get(connection_string)
+
+            if engine is None:
+                # connections can stay idle long between pipeline runs: check them before use
+                engine = create_engine(connection_string, echo=False, pool_pre_ping=True)
+                ENGINES[connection_string] = engine
+
+        return engine
 
     # ----
 
@@ -105,8 +127,8 @@ class Database:
                 self.connection_string = '{0}://{1}:{2}@{3}:{4}/{5}'.format(self.db_type, self.user, self.password,
                                                                             self.url, self.port, self.name)
 
-            # create engine and connect
-            self.engine = create_engine(self.connection_string, echo=False)
+            # get engine and connect
+            self.engine = Database.get_engine(self.connection_string)
 
             self.inspector = inspect(self.engine)
             self.failed_connection = False
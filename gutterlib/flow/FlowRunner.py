@@ -0,0 +1,432 @@
+"""
+
+    FlowRunner.py
+
+    * Runs the pipelines that need doing concurrently in a pool of workers ( threads or processes )
+    * Every pipeline job gets its own GutterFlow and GutterStore with their own database sessions
+    * Jobs go through the job queue in the gutter database ( see JobQueue ): many runners can work together
+    * The runner sleeps until the next pipeline is due ( see Scheduler )
+
+"""
+
+import concurrent.futures
+import multiprocessing
+import threading
+import datetime
+import logging
+import signal
+
+from .GutterFlow import GutterFlow
+from .JobQueue import JobQueue
+from .Scheduler import Scheduler
+from ..datastore.GutterStore import GutterStore
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineTimeout(Exception):
+    pass
+
+
+# ==== worker functions: on module level so they can be used in worker processes ==== #
+
+def setup_worker(max_memory_mb=None):
+
+    """ Initialize worker process: limits and signals
+        Only the runner handles SIGTERM and SIGINT: the worker finishes its job when the runner shuts down
+
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    if max_memory_mb:
+        try:
+            import resource  # NOTE: only on unix
+            limit = int(max_memory_mb) * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except Exception as e:
+            logger.warning("Could not set memory limit of worker: {0}".format(e))
+
+# ----
+
+
+def run_pipeline_job(gutter_database, pipeline_name, timeout=None, job_id=None, runner_id=None):
+
+    """ Execute one pipeline with its own GutterFlow and GutterStore
+        With a job_id the lease on the job is extended with heartbeats while the pipeline runs 
+        and the job is finished afterwards. When the lease is lost the pipeline stops at its next batch
+
+    :param gutter_database: dict with connection parameters of gutter database { db_type, url, port, user, password, name }
+    :param pipeline_name: name of pipeline to execute
+    :param timeout: maximum number of seconds: only in worker processes ( it uses SIGALRM )
+    :param job_id: id of claimed job in queue
+    :param runner_id: id of runner that claimed the job
+    :return: bool -- Success or Fail
+
+    """
+
+    gutter_flow = GutterFlow()
+    gutter_store = GutterStore()
+    job_queue = None
+    stop_heartbeat = None
+    lost_lease = threading.Event()
+
+    try:
+        if not gutter_flow.connect(**gutter_database) or not gutter_store.connect(**gutter_database):
+            logger.error("Pipeline job '{0}': cannot connect to gutter database".format(pipeline_name))
+            return False
+
+        gutter_flow.connect_gutter_store(gutter_store)
+
+        if job_id is not None:
+            job_queue = JobQueue(gutter_flow.db_engine, runner_id)
+            gutter_flow.cancel_event = lost_lease  # another runner can have claimed the job: don't run it twice
+            stop_heartbeat = job_queue.start_heartbeat(job_id, lost_lease)
+
+        use_alarm = timeout and threading.current_thread() is threading.main_thread()
+
+        if use_alarm:
+            signal.signal(signal.SIGALRM, raise_pipeline_timeout)
+            signal.alarm(int(timeout))
+
+        error = None
+
+        try:
+            success = gutter_flow.execute_pipeline_by_name(pipeline_name) is True
+
+        except PipelineTimeout:
+            error = "took more than {0}s: stopped".format(timeout)
+
+        except Exception as e:
+            error = "failed: {0}".format(e)
+
+        finally:
+            if use_alarm:
+                signal.alarm(0)
+
+        if lost_lease.is_set():
+            logger.error("Pipeline job '{0}' lost its lease: stopped".format(pipeline_name))
+            return False
+
+        if error is not None:
+            logger.error("Pipeline job '{0}' {1}".format(pipeline_name, error))
+            release_pipeline(gutter_flow, pipeline_name)
+            success = False
+
+        if job_queue is not None:
+            job_queue.finish(job_id, success, error)
+
+        return success
+
+    except Exception as e:
+        logger.error("Pipeline job '{0}' failed: {1}".format(pipeline_name, e))
+        return False
+
+    finally:
+        if stop_heartbeat is not None:
+            stop_heartbeat.set()
+
+        gutter_flow.disconnect()
+        gutter_store.disconnect()
+
+# ----
+
+
+def release_pipeline(gutter_flow, pipeline_name):
+
+    # after a broken job: pipeline is not executing anymore so it can run again
+    gutter_flow.db_session.rollback()
+
+    pipeline = gutter_flow.get_pipeline(pipeline_name)
+
+    if pipeline is not None:
+        pipeline.executing = False
+        gutter_flow.update_pipelines()
+
+# ----
+
+
+def raise_pipeline_timeout(signum, frame):
+
+    raise PipelineTimeout()
+
+
+# ==== runner ==== #
+
+class FlowRunner:
+
+    def __init__(self, gutter_database, workers=4, worker_type='thread', max_memory_mb=None, max_jobs_per_worker=None):
+
+        """
+        :param gutter_database: dict with connection parameters of gutter database { db_type, url, port, user, password, name }
+        :param workers: number of pipelines that can run at the same time
+        :param worker_type: 'thread' or 'process'
+        :param max_memory_mb: memory limit per worker ( only process )
+        :param max_jobs_per_worker: start a new worker process after this number of jobs ( only process, python 3.11+ )
+
+        """
+
+        # settings
+        self.RELOAD_SECONDS = 300  # reload schedule of pipelines from database every X seconds ( the old poll interval )
+        self.WORKERS = int(workers)
+        self.WORKER_TYPE = worker_type
+        self.MAX_MEMORY_MB = max_memory_mb
+        self.MAX_JOBS_PER_WORKER = max_jobs_per_worker
+        self.DEFAULT_TIMEOUT = 60 * 60  # seconds: when pipeline has no max_duration ( only process )
+
+        # properties
+        self.gutter_database = gutter_database
+        self.gutter_flow = None  # only to check which pipelines need doing
+        self.job_queue = None
+        self.scheduler = Scheduler()
+        self.executor = None
+        self.running_jobs = {}  # job id : future
+        self.stopping = threading.Event()
+        self.wake_up = threading.Event()  # set when a worker is free or on stop
+
+        self.logger = logger
+
+    # ----
+
+    def start(self):
+
+        """ Run pipelines until SIGTERM or SIGINT
+
+        """
+
+        self.gutter_flow = GutterFlow()
+
+        if not self.gutter_flow.connect(**self.gutter_database):
+            self.logger.error("FlowRunner: cannot connect to gutter database!")
+            return False
+
+        self.job_queue = JobQueue(self.gutter_flow.db_engine)
+        self.job_queue.create_table()
+
+        signal.signal(signal.SIGTERM, self.handle_stop_signal)
+        signal.signal(signal.SIGINT, self.handle_stop_signal)
+
+        self.executor = self.create_executor()
+
+        self.logger.info("==== start flow runner '{0}' with {1} {2} workers ====".format(
+            self.job_queue.runner_id, self.WORKERS, self.WORKER_TYPE))
+
+        while not self.stopping.is_set():
+            try:
+                if self.needs_reload():
+                    self.reload_schedule()
+
+                self.enqueue_due_pipelines()
+                self.run_queued_jobs()
+
+            except Exception as e:
+                self.logger.error("FlowRunner: {0}".format(e))
+                self.gutter_flow.db_session.rollback()
+
+            # sleep until next pipeline is due, but wake up directly on stop or free worker
+            self.wake_up.wait(self.get_sleep_seconds())
+            self.wake_up.clear()
+
+        self.stop()
+
+        return True
+
+    # ----
+
+    def create_executor(self):
+
+        if self.WORKER_TYPE == 'process':
+            options = {'max_workers': self.WORKERS,
+                       'mp_context': multiprocessing.get_context('spawn'),  # no copies of open connections
+                       'initializer': setup_worker,
+                       'initargs': (self.MAX_MEMORY_MB,)}
+
+            if self.MAX_JOBS_PER_WORKER:
+                options['max_tasks_per_child'] = int(self.MAX_JOBS_PER_WORKER)
+
+            try:
+                return concurrent.futures.ProcessPoolExecutor(**options)
+            except TypeError:
+                self.logger.warning("max_jobs_per_worker needs python 3.11 or higher: ignored")
+                del options['max_tasks_per_child']
+                return concurrent.futures.ProcessPoolExecutor(**options)
+
+        return concurrent.futures.ThreadPoolExecutor(max_workers=self.WORKERS, thread_name_prefix='gutter_worker')
+
+    # ----
+
+    def needs_reload(self, now=None):
+
+        now = now or datetime.datetime.now()
+
+        return self.scheduler.last_reload is None or \
+            (now - self.scheduler.last_reload).total_seconds() >= self.RELOAD_SECONDS
+
+    # ----
+
+    def reload_schedule(self):
+
+        """ Schedule all pipelines from database: pipelines can be added or changed
+
+        """
+
+        self.gutter_flow.db_session.expire_all()  # pipelines can be changed by other sessions ( workers )
+        self.gutter_flow.check_pipelines_time_out()
+
+        self.scheduler.reload(self.gutter_flow.get_pipelines())
+
+        self.gutter_flow.db_session.rollback()  # end transaction: don't keep locks on pipelines
+
+        seconds = self.scheduler.get_seconds_until_next()
+
+        if seconds is not None:
+            self.logger.info("Next pipeline is due in {0:.0f}s".format(seconds))
+
+    # ----
+
+    def get_sleep_seconds(self, now=None):
+
+        now = now or datetime.datetime.now()
+
+        seconds_until_reload = self.RELOAD_SECONDS - (now - self.scheduler.last_reload).total_seconds()
+        seconds_until_due = self.scheduler.get_seconds_until_next(now)
+
+        if seconds_until_due is None:
+            return max(0.0, seconds_until_reload)
+
+        return max(0.0, min(seconds_until_reload, seconds_until_due))
+
+    # ----
+
+    def enqueue_due_pipelines(self):
+
+        """ Put the pipelines that are due by the schedule in the job queue
+            Pipelines that already have a queued or running job ( by any runner ) are skipped by the queue
+
+        :return: list of names of queued pipelines --
+
+        """
+
+        due = self.scheduler.pop_due()
+
+        if len(due) == 0:
+            return []
+
+        queued = []
+        now = datetime.datetime.now()
+
+        self.gutter_flow.db_session.expire_all()
+
+        for pipeline_id, pipeline_name, fire_time in due:
+            pipeline = self.gutter_flow.get_pipeline(pipeline_name)  # latest state: other runners can have run it
+
+            if pipeline is None:
+                continue
+
+            if pipeline.needs_doing(fire_time) and self.job_queue.enqueue(pipeline) is not None:
+                queued.append(pipeline.name)
+
+                self.logger.info("=> queued pipeline '{0}' ( due at {1}, {2:.1f}s late )".format(
+                    pipeline.name, fire_time, (now - fire_time).total_seconds()))
+
+            # next run: counts from now, the actual last run of the pipeline is used on next reload
+            self.scheduler.schedule(pipeline.id, pipeline.name, pipeline.run_at, now, now)
+
+        self.gutter_flow.db_session.rollback()  # end transaction: don't keep locks on pipelines
+
+        self.job_queue.purge_finished_jobs()
+
+        return queued
+
+    # ----
+
+    def run_queued_jobs(self):
+
+        """ Claim queued jobs for the free workers and start them
+
+        :return: list of names of started pipelines --
+
+        """
+
+        # forget finished jobs
+        for job_id, job in list(self.running_jobs.items()):
+            if job.done():
+                del self.running_jobs[job_id]
+
+        started = []
+
+        while len(self.running_jobs) < self.WORKERS and not self.stopping.is_set():
+            claimed_job = self.job_queue.claim()
+
+            if claimed_job is None:
+                break
+
+            timeout = None
+
+            if self.WORKER_TYPE == 'process':
+                pipeline = self.gutter_flow.get_pipeline(claimed_job['pipeline_name'])
+                timeout = (pipeline.max_duration if pipeline is not None else None) or self.DEFAULT_TIMEOUT
+
+            job = self.executor.submit(run_pipeline_job, self.gutter_database, claimed_job['pipeline_name'], timeout,
+                                       claimed_job['id'], self.job_queue.runner_id)
+            job.add_done_callback(self.make_job_done_callback(claimed_job['pipeline_name']))
+
+            self.running_jobs[claimed_job['id']] = job
+            started.append(claimed_job['pipeline_name'])
+
+        self.gutter_flow.db_session.rollback()
+
+        if len(started) > 0:
+            self.logger.info("=> started pipelines: {0} ( {1} running )".format(', '.join(started),
+                                                                              len(self.running_jobs)))
+
+        return started
+
+    # ----
+
+    def make_job_done_callback(self, pipeline_name):
+
+        def job_done(job):
+            if job.cancelled():
+                self.logger.info("Pipeline job '{0}' cancelled".format(pipeline_name))
+            elif job.exception() is not None:
+                self.logger.error("Pipeline job '{0}' failed: {1}".format(pipeline_name, job.exception()))
+            else:
+                self.logger.info("Pipeline job '{0}' done: {1}".format(pipeline_name,
+                                                                      'success' if job.result() else 'failed'))
+
+            self.wake_up.set()  # claim next job
+
+        return job_done
+
+    # ----
+
+    def handle_stop_signal(self, signum, frame):
+
+        self.logger.info("FlowRunner: got signal {0}: stop after running jobs".format(signum))
+        self.stopping.set()
+        self.wake_up.set()
+
+    # ----
+
+    def stop(self):
+
+        """ Clean shutdown: jobs that did not start yet are cancelled, running jobs are finished
+
+        """
+
+        self.stopping.set()
+
+        if self.executor is not None:
+            for job_id, job in self.running_jobs.items():
+                if job.cancel():  # only works for jobs that did not start
+                    self.job_queue.release(job_id)  # another runner can do it
+
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+        if self.gutter_flow is not None:
+            self.gutter_flow.disconnect()
+
+        self.logger.info("==== flow runner stopped ====")
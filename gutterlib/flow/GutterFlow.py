@@ -16,15 +16,25 @@ import datetime
 import re
 import math
 
-import copy
+from collections import OrderedDict
+
 import simplejson as json
 
 from .Pipeline import Pipeline
 from .Database import Database
 from .ApiSource import ApiSource
+from .JsonCoercer import JsonCoercer
+from .UnchangedPage import UnchangedPage
+from .Scheduler import Scheduler
 
 DBObj = declarative_base()
 
+MAP_INPUT_PROPERTY_PATTERN = re.compile(r'''^\s*input\[(['"])(\w+)\1\]\s*$''')  # input['column']
+
+
+class PipelineCancelled(Exception):
+    pass
+
 
 class GutterFlow:
 
@@ -32,6 +42,9 @@ class GutterFlow:
 
         # settings
         self.BATCHSIZE = 50
+        self.SOURCE_READ_MODE = 'keyset'  # keyset, offset or stream: can be set per pipeline in data_source['read_mode']
+        self.INITIAL_LOAD_WITH_COPY = True  # load empty tables with COPY: force or disable per pipeline in data_source['copy_load']
+        self.DETECT_DELETES = False  # delete rows that are gone from the source: can be set per pipeline in data_source['detect_deletes']
 
         # properties
         self.db_engine = None
@@ -43,6 +56,8 @@ class GutterFlow:
         self.has_connection = False
         self.gutter_store = None  # manager of gutter_store to push the data to
         self.api_source = None
+        self.scheduler = Scheduler()  # fire times of pipelines for do_jobs
+        self.cancel_event = None  # threading.Event: when set the running transfer stops at the next batch
 
         # setup
         self.setup_logger()
@@ -52,7 +67,10 @@ class GutterFlow:
     def __del__(self):
         # cleanup all connections
         if self.db_engine:
-            self.db_engine.dispose()
+            try:
+                self.db_engine.dispose()
+            except Exception as e:
+                pass  # can fail at exit of interpreter
 
     # ----
 
@@ -107,6 +125,8 @@ class GutterFlow:
             self.has_connection = True  # if connection is succesful this flag is set, otherwise Exception will happen
             self.logger.info("Succesfully connected to Gutter database")
 
+            self.upgrade_pipelines_table()
+
             return True
 
         except Exception as e:
@@ -117,6 +137,53 @@ class GutterFlow:
 
     # ----
 
+    def upgrade_pipelines_table(self):
+
+        """ Bring existing pipelines table up to date with the Pipeline model
+            ( create_all only creates missing tables, it does not add columns )
+        
+        """
+
+        sqls = ['ALTER TABLE IF EXISTS gutter.pipelines ADD COLUMN IF NOT EXISTS watermark_column VARCHAR(255)',
+                'ALTER TABLE IF EXISTS gutter.pipelines ADD COLUMN IF NOT EXISTS last_watermark VARCHAR(255)',
+                'ALTER TABLE IF EXISTS gutter.pipelines ADD COLUMN IF NOT EXISTS page_validators JSONB']
+
+        for sql in sqls:
+            try:
+                self.db_session.execute(sql)
+                self.db_session.commit()
+            except Exception as e:
+                self.db_session.rollback()
+                self.logger.error("upgrade_pipelines_table failed: {0}".format(e))
+                return False
+
+        return True
+
+    # ----
+
+    def disconnect(self):
+
+        # close session and all connections ( for example at the end of a worker job )
+        if self.db_session is not None:
+            self.db_session.close()
+
+        if self.db_engine:
+            self.db_engine.dispose()
+
+        self.close_api_source()
+
+        self.has_connection = False
+
+    # ----
+
+    def close_api_source(self):
+
+        if self.api_source is not None:
+            self.api_source.close()
+            self.api_source = None
+
+    # ----
+
     def connect_gutter_store(self, gutter_store):
 
         self.gutter_store = gutter_store
@@ -195,12 +262,28 @@ class GutterFlow:
         self.logger.info(
             "do_jobs: check if we need to run any of the {0} pipelines: '{1}'".format(len(pipelines), pipeline_names))
 
+        # new pipelines get a fire time, known ones keep theirs until they are due ( see Scheduler )
         for pipeline in pipelines:
-            if pipeline.needs_doing():
+            if pipeline.id not in self.scheduler.fire_times:
+                self.scheduler.schedule(pipeline.id, pipeline.name, pipeline.run_at, pipeline.last_run)
+
+        pipelines_by_id = dict((pipeline.id, pipeline) for pipeline in pipelines)
+        num_executed = 0
+
+        for pipeline_id, pipeline_name, fire_time in self.scheduler.pop_due():
+            pipeline = pipelines_by_id.get(pipeline_id)
+
+            if pipeline is None:
+                continue
+
+            if pipeline.needs_doing(fire_time):
                 self.logger.info("Start pipeline {0}".format(pipeline.name))
                 self.execute_pipeline(pipeline)
+                num_executed += 1
+
+            self.scheduler.schedule(pipeline.id, pipeline.name, pipeline.run_at, datetime.datetime.now())
 
-        if not True in [pipeline.needs_doing() for p in pipelines]:
+        if num_executed == 0:
             self.logger.info("No pipelines that needed execution!")
 
         return True
@@ -220,9 +303,9 @@ class GutterFlow:
         DEFAULT_TIMEOUT = 60 * 10  # 10 minutes
 
         for pipeline in pipelines:
-            if pipeline.executing:
+            if pipeline.executing and pipeline.last_run is not None:
                 execution_duration = (datetime.datetime.now() - pipeline.last_run).total_seconds()
-                time_out_duration = pipeline.max_duration or default_timeout
+                time_out_duration = pipeline.max_duration or DEFAULT_TIMEOUT
 
                 if execution_duration > time_out_duration:
                     pipeline.executing = False  # cancel execution state to fix broken pipelines
@@ -293,7 +376,9 @@ class GutterFlow:
                 pipeline)  # data_source: dict with { type, url, user, port, password, schema, table }
         else:
             # API pipeline
+            self.close_api_source()  # of an earlier run
             self.api_source = ApiSource(pipeline.data_source)
+            self.api_source.page_validators = pipeline.page_validators or {}
             pipeline.source_schema_definition = self.api_source.get_schema_definition(title=pipeline.name)
 
         # check for source_schema_definition
@@ -338,14 +423,26 @@ class GutterFlow:
 
         # step 9: check results and output
 
+        if results is not False and pipeline.next_watermark is not None:
+            pipeline.last_watermark = pipeline.next_watermark  # next run starts from here
+            self.update_pipelines()
+
+        if results is not False and pipeline.type == 'api' and self.api_source is not None:
+            pipeline.page_validators = self.api_source.new_page_validators  # next run can skip unchanged pages
+            self.update_pipelines()
+
+        if self.api_source is not None:
+            self.api_source.close()  # don't keep idle connections to the API
+
         if results is False:
             self.logger.info("==== Pipeline job '{0}' failed. See ERROR above ====")
             return False
         else:
             self.logger.info(
-                "==== Pipeline job '{0}' successful with {1} new and {2} updates and the same {3} ( took: {4}s ) ====".format(
+                "==== Pipeline job '{0}' successful with {1} new and {2} updates and the same {3} "
+                "and {4} deleted ( took: {5}s ) ====".format(
                     pipeline.name, results.get('new'), results.get('updates'), results.get('same'),
-                    pipeline.last_duration))
+                    results.get('deleted', 0), pipeline.last_duration))
             return True
 
     # ----
@@ -374,6 +471,7 @@ class GutterFlow:
         source_database = self.get_database(data_source_obj)
         pipeline.source_table = source_database.get_table(schema=data_source_obj.get('schema'),
                                                           name=data_source_obj.get('table'))
+        pipeline.source_table.set_primary_key(pipeline.primary_key)
 
         # save on pipeline instance
         pipeline.source_schema_definition = pipeline.source_table.get_schema_definition()  # json schema definition of data
@@ -454,9 +552,10 @@ class GutterFlow:
 
         storage_model = self.gutter_store.get_storage_model(table_name)
 
-        # make sure we have a real table for this model
+        # make sure we have a real and up to date table for this model
         if storage_model:
             storage_model().create_table(engine=self.db_engine)  # create table if not exists
+            self.gutter_store.upgrade_storage_table(table_name)
 
         return storage_model
 
@@ -493,7 +592,7 @@ class GutterFlow:
             - we use GutterStore to handle all storages ( don't mix database sessions )
             - we query source data through the pipeline.source_table GutterFlow Table instance
         
-        :return False ( fail ) or result stats dict { updates : integer, new : integer , same : integer }  
+        :return False ( fail ) or result stats dict { updates : integer, new : integer , same : integer, deleted : integer }  
         
         """
 
@@ -526,189 +625,517 @@ class GutterFlow:
 
         self.logger.info("Transfer data with primary_key_name : '{0}'".format(primary_key_name))
 
-        # start batch rows
-        batch_num = 0
+        if not self.setup_watermark(pipeline):
+            return False
 
-        if pipeline.type == 'database':
-            # NOTE: table instance maintains its own database session of the source database
-            # NOTE: in the start_query() function we use order_by(Model.id) to ensure we get all the data ordered by id
-            source_rows_in_batch = pipeline.source_table.start_query().offset(0).limit(self.BATCHSIZE).all()
-        elif pipeline.type == 'api':
-            if self.api_source is None:  # make sure it is here
-                self.api_source = ApiSource(pipeline.data_source)
-            source_rows_in_batch = self.api_source.get_batch_rows(batch_num)
+        # source schema and column types can be changed since the last run: compile for this run only
+        compiled_map = self.get_compiled_map(pipeline)
+        select_columns = self.get_select_columns(pipeline, compiled_map, primary_key_name)  # None: map per row
+
+        # ids of all source rows: to find the rows that are deleted in the source
+        seen_ids = set() if self.needs_delete_detection(pipeline, has_history=HistoryModel is not None) else None
+
+        # first load into an empty table ( or forced for this pipeline ): stream everything with COPY
+        copy_load = (pipeline.data_source or {}).get('copy_load')
+
+        if copy_load is True or (copy_load is None and self.INITIAL_LOAD_WITH_COPY):
+            table_is_empty = self.gutter_store.table_is_empty(StorageModel.__tablename__)
+
+            if copy_load is True or table_is_empty:
+                results = self.transfer_data_with_copy(pipeline, StorageModel.__tablename__, primary_key_name,
+                                                       compiled_map, staging=not table_is_empty,
+                                                       keep_history=HistoryModel is not None,
+                                                       seen_ids=seen_ids)
+                if results is not None:
+                    if not self.source_read_is_complete(pipeline):
+                        return False
+
+                    return self.delete_missing_rows(pipeline, StorageModel.__tablename__, seen_ids, results)
+
+                if self.is_cancelled():
+                    self.logger.error("Transfer of pipeline '{0}' cancelled".format(pipeline.name))
+                    return False
+
+                self.logger.warning("COPY load failed: fall back to transfer in batches")
 
         # main transfer loop
         num_new_rows = 0
         num_updated_rows = 0
         num_same_rows = 0
 
-        while len(source_rows_in_batch) != 0:
+        if pipeline.type == 'api' and self.api_source is not None:
+            # conditional requests: pages that did not change since last run are skipped ( not with delete detection )
+            self.api_source.use_page_validators = seen_ids is None and \
+                                                  not self.gutter_store.table_is_empty(StorageModel.__tablename__)
+
+        for batch_num, source_rows_in_batch in enumerate(self.get_source_batches(pipeline, select_columns)):
+
+            if self.is_cancelled():
+                self.logger.error("Transfer of pipeline '{0}' cancelled before batch {1}".format(pipeline.name,
+                                                                                                 batch_num))
+                return False
+
+            if isinstance(source_rows_in_batch, UnchangedPage):
+                num_same_rows += len(source_rows_in_batch)
+                self.logger.info('==> batch {0} not modified since last run: skipped {1} rows'.format(
+                    batch_num, len(source_rows_in_batch)))
+                continue
 
             # try:
-            sync_table = {}  # table with source rows and storage rows by primary key
+            storage_rows = {}  # storage rows ( id, mapped data ) by primary key
 
-            for obj in source_rows_in_batch:
-                # object can be a SourceRow object ( from database ) or a dict from API
+            # maps source data to storage data, the map can contain python functions
+            for id, mapped_data in self.map_batch(source_rows_in_batch, primary_key_name, compiled_map, select_columns):
+                storage_rows[str(id)] = {'id': str(id), 'data': mapped_data,
+                                         'datahash': self.gutter_store.get_data_hash(mapped_data)}
 
-                if isinstance(obj, dict):
-                    id = obj.get(primary_key_name)
-                else:
-                    id = getattr(obj, primary_key_name)
+            if seen_ids is not None:
+                seen_ids.update(storage_rows.keys())
 
-                sync_table[str(id)] = {'id': str(id), 'source': obj,
-                                       'storage': None}  # synctable by id, with source row object and storage row object
+            # skip unchanged rows by comparing data hashes: we don't need to load or send their data
+            stored_hashes = self.gutter_store.get_datahashes_by_ids(table_name=StorageModel.__tablename__,
+                                                                    ids=list(storage_rows.keys()))
+            same_ids = [id for id, row in storage_rows.items() if stored_hashes.get(id) == row['datahash']]
+            changed_rows = [row for id, row in storage_rows.items() if stored_hashes.get(id) != row['datahash']]
 
-            # find existing storage rows with incoming ids ( to update later )
-            storage_rows = self.gutter_store.get_model_rows_by_ids(model=StorageModel, ids=sync_table.keys())
+            self.gutter_store.touch_rows(table_name=StorageModel.__tablename__, ids=same_ids)
 
-            for existing_row in storage_rows:
-                sync_table[str(existing_row.id)]['storage'] = existing_row
+            # now do sync: insert or check/update in one statement, the comparison of data is done by the database
+            batch_results = self.gutter_store.bulk_upsert(table_name=StorageModel.__tablename__,
+                                                          rows=changed_rows,
+                                                          pipeline_id=pipeline.id,
+                                                          keep_history=HistoryModel is not None)
 
-            # now do sync: insert or check/update
-            new_rows = []
-            new_history_rows = []
-            updated_rows = []
-            same_rows = []
+            if batch_results is None:
+                self.logger.error("Failed batch {0} of pipeline '{1}'".format(batch_num, pipeline.name))
+                return False
 
-            # iterate over primary keys if incoming source rows
-            for id in sync_table.keys():
+            self.gutter_store.commit()  # make update
 
-                sync_row = sync_table[id]
-                sync_source_row = sync_row['source']  # can be source_row object or dict from api
-                sync_storage_row = sync_row['storage']
+            batch_results['same'] += len(same_ids)
 
-                now = datetime.datetime.now()
+            num_new_rows += batch_results['new']
+            num_updated_rows += batch_results['updates']
+            num_same_rows += batch_results['same']
 
-                # map data
-                mapped_data = self.map_data(sync_source_row, sync_storage_row,
-                                            pipeline.map)  # maps source data to storage data, the map can contain python functions
+            # debug
+            self.logger.info('==> batch {0} with {1} inserts, '
+                             '{2} updates and {3} remained the same'.format(
+                batch_num,
+                batch_results['new'],
+                batch_results['updates'],
+                batch_results['same']))
 
-                if sync_storage_row is None:  # new row
-                    # self.logger.warning('no existing row found for id {0}, create new'.format(id))
+        # something terrible executing this batch
+        # except Exception as e:
+        #    self.logger.error("Failed batch: {0}".format(e))
+        #    return False
 
-                    # create new storage row
-                    new_storage_row = StorageModel(id=id,
-                                                   created_at=now,
-                                                   last_checked=now,
-                                                   last_updated=now,
-                                                   pipeline_id=pipeline.id,
-                                                   data=mapped_data)
+        # end while loop and return total results
+        results = {'updates': num_updated_rows, 'new': num_new_rows, 'same': num_same_rows}
 
-                    new_rows.append(new_storage_row)
+        if not self.source_read_is_complete(pipeline):
+            return False
 
-                else:
-                    # update row
+        return self.delete_missing_rows(pipeline, StorageModel.__tablename__, seen_ids, results)
 
-                    # DEBUG row data comparison
-                    # self.logger.info("existing row: {0} <===> new row: {1}".format(sync_storage_row.data, mapped_data))
+    # ----
 
-                    if sync_storage_row.data != mapped_data:
+    def is_cancelled(self):
 
-                        if HistoryModel:
-                            # save old data in history row
-                            sync_history_row = HistoryModel(row_id=sync_storage_row.id, pipeline_id=pipeline.id)
-                            sync_history_row.data = copy.deepcopy(sync_storage_row.data)
-                            sync_history_row.valid_from = sync_storage_row.last_updated
-                            sync_history_row.valid_to = now
-                            new_history_rows.append(sync_history_row)
+        # the job of this transfer was stopped ( for example: lost its lease in the job queue )
+        return self.cancel_event is not None and self.cancel_event.is_set()
 
-                            sync_storage_row.data = {}
-                            sync_storage_row.data = mapped_data
-                            sync_storage_row.last_checked = datetime.datetime.now()
-                            sync_storage_row.last_updated = datetime.datetime.now()
+    # ----
 
-                            updated_rows.append(sync_storage_row)
+    def source_read_is_complete(self, pipeline):
 
-                    else:
-                        sync_storage_row.last_checked = now
-                        same_rows.append(sync_storage_row)
+        """ Check that the source was read to its end: a read that stopped on a failed request 
+            looks like the end of the source. Then the run fails: no delete detection 
+            ( all rows after the failed page would be deleted ) and no saved validators or watermark
+        
+        :return: bool --
+        
+        """
 
-                        # batch end
-            if len(new_rows) > 0:
-                self.gutter_store.add_rows(new_rows)
-                num_new_rows += len(new_rows)
-            if len(new_history_rows) > 0:
-                self.gutter_store.add_rows(new_history_rows)
-                num_updated_rows += len(updated_rows)
+        if pipeline.type != 'api' or self.api_source is None or not self.api_source.has_fetch_errors():
+            return True
 
-            num_same_rows += len(same_rows)
+        url, error = self.api_source.fetch_errors[0]
+        self.logger.error("Reading source of pipeline '{0}' stopped on a failed request for '{1}': {2}. "
+                          "Skipped delete detection".format(pipeline.name, url, error))
 
-            self.gutter_store.commit()  # make update
+        return False
 
-            # debug
-            self.logger.info('==> batch {0} with {1} inserts, '
-                             '{2} updates and {3} remained the same'.format(
-                batch_num,
-                len(new_rows),
-                len(updated_rows),
-                len(same_rows)))
+    # ----
 
-            batch_num += 1
+    def needs_delete_detection(self, pipeline, has_history=True):
 
-            # get new batchget_model
-            if pipeline.type == 'database':
-                source_rows_in_batch = pipeline.source_table.start_query().offset(batch_num * self.BATCHSIZE).limit(
-                    self.BATCHSIZE).all()  # important: don't use self.db_session since that is gutter db
-            elif pipeline.type == 'api':
-                source_rows_in_batch = self.api_source.get_batch_rows(batch_num)
+        detect_deletes = (pipeline.data_source or {}).get('detect_deletes')
 
-        # something terrible executing this batch
-        # except Exception as e:
-        #    self.logger.error("Failed batch: {0}".format(e))
-        #    return False
+        if detect_deletes is None:
+            detect_deletes = self.DETECT_DELETES
 
-        # end while loop and return total results
-        return {'updates': num_updated_rows, 'new': num_new_rows, 'same': num_same_rows}
+        if detect_deletes and pipeline.watermark_column:
+            # a delta sync only reads the changed rows: all others would look deleted
+            self.logger.warning("Cannot detect deletes with delta sync on watermark column '{0}': skipped".format(
+                pipeline.watermark_column))
+            return False
 
-        # ----
+        if detect_deletes and not has_history:
+            # deleted rows are closed in the history table: without it their data would be lost
+            self.logger.error("Cannot detect deletes of pipeline '{0}' without a history table: skipped".format(
+                pipeline.name))
+            return False
+
+        return bool(detect_deletes)
 
-    def map_data(self, source_obj, storage_obj, map):
+    # ----
 
+    def delete_missing_rows(self, pipeline, table_name, seen_ids, results):
+
+        """ Delete the stored rows that were not in the source during this run ( see GutterStore.delete_missing_rows )
+        
+        :param seen_ids: set of ids of source rows or None for no delete detection
+        :param results: result stats dict of transfer
+        :return False ( fail ) or result stats dict with deleted --
+        
         """
-            Map a source row to a storage row
 
-            :param source_obj: Can be a ORM Row instance or dict ( from API )
-            :param storage_obj: ORM GutterRow instance
-            :return: dict -- the data in key,value pair dict
+        results['deleted'] = 0
+
+        if seen_ids is None:
+            return results
+
+        if len(seen_ids) == 0:
+            # more likely a source problem than a source without rows
+            self.logger.warning("No rows in source of pipeline '{0}': skip delete detection".format(pipeline.name))
+            return results
+
+        num_deleted = self.gutter_store.delete_missing_rows(table_name=table_name, seen_ids=seen_ids,
+                                                            pipeline_id=pipeline.id)
+
+        if num_deleted is None:
+            self.logger.error("Failed delete detection of pipeline '{0}'".format(pipeline.name))
+            return False
+
+        self.gutter_store.commit()
+
+        self.logger.info("==> deleted {0} rows that are not in the source anymore".format(num_deleted))
+
+        results['deleted'] = num_deleted
+
+        return results
+
+    # ----
+
+    def setup_watermark(self, pipeline):
+
+        """ Delta sync: only read the rows of the source that changed since the last run
+            The highest value of the watermark column now is the watermark of this run. 
+            It is saved on the pipeline when the run succeeds
+        
+        :return: bool -- Success or Fail
         
         """
 
-        json_data = {}  # on storage row object
+        pipeline.next_watermark = None
+
+        if not pipeline.watermark_column:
+            return True
+
+        if pipeline.type == 'api':
+            self.logger.warning("Watermark column is only for database pipelines: do full sync")
+            return True
+
+        source_table = pipeline.source_table
+
+        if pipeline.watermark_column not in pipeline.source_schema_definition.get('properties', {}):
+            self.logger.error("Watermark column '{0}' is not in source '{1}'".format(pipeline.watermark_column,
+                                                                                    source_table.name))
+            return False
+
+        try:
+            max_value = source_table.get_watermark_max(pipeline.watermark_column, pipeline.last_watermark)
+        except Exception as e:
+            self.logger.error("Could not get watermark of source '{0}': {1}".format(source_table.name, e))
+            return False
+
+        # no new rows: read nothing
+        pipeline.next_watermark = max_value
+        source_table.set_watermark(pipeline.watermark_column, pipeline.last_watermark,
+                                   max_value if max_value is not None else pipeline.last_watermark)
+
+        self.logger.info("Delta sync on '{0}' from '{1}' up to '{2}'".format(
+            pipeline.watermark_column, pipeline.last_watermark, max_value))
+
+        return True
+
+    # ----
+
+    def transfer_data_with_copy(self, pipeline, table_name, primary_key_name, compiled_map, staging=False,
+                                keep_history=True, seen_ids=None):
+
+        """ Transfer all source data in one COPY ... FROM STDIN stream
+            
+            For the first load into an empty table every row is new: no lookups or comparisons are needed.
+            The indices on the data are dropped first and made again afterwards, which is a lot faster than 
+            updating them for every row. With staging ( table not empty ) the rows are upserted from a temporary table
+        
+        :param compiled_map: compiled map of this run ( see get_compiled_map )
+        :param seen_ids: set that collects the ids of the source rows ( optional )
+        :return None ( fail ) or result stats dict { updates : integer, new : integer , same : integer }
+        
+        """
+
+        self.logger.info("Transfer data of pipeline '{0}' with COPY ( staging: {1} )".format(pipeline.name, staging))
+
+        select_columns = self.get_select_columns(pipeline, compiled_map, primary_key_name)
+
+        def storage_rows():
+            for batch_num, source_rows_in_batch in enumerate(self.get_source_batches(pipeline, select_columns)):
+                if self.is_cancelled():
+                    raise PipelineCancelled()  # the COPY is rolled back
+
+                for id, mapped_data in self.map_batch(source_rows_in_batch, primary_key_name, compiled_map,
+                                                      select_columns):
+                    if seen_ids is not None:
+                        seen_ids.add(str(id))
+
+                    yield {'id': str(id), 'data': mapped_data}
+
+                self.logger.info('==> batch {0} streamed to COPY'.format(batch_num))
+
+        if not staging:
+            self.gutter_store.drop_indices(table_name)
+
+        results = self.gutter_store.copy_rows(table_name=table_name, rows=storage_rows(), pipeline_id=pipeline.id,
+                                              staging=staging, keep_history=keep_history)
+
+        if not staging:
+            self.gutter_store.create_indices(table_name=table_name,
+                                             schema_definition=self.get_target_schema_definition(pipeline))
+
+        return results
+
+    # ----
+
+    def get_target_schema_definition(self, pipeline):
+
+        # schema definition of the mapped data: only the source properties that are in the map
+        # NOTE: the types of expressions in the map are unknown
+
+        source_properties = pipeline.source_schema_definition.get('properties', {})
+
+        return {'title': pipeline.source_schema_definition.get('title'),
+                'properties': dict((output_property, source_properties[output_property]) for output_property in
+                                   pipeline.map if output_property in source_properties)}
+
+    # ----
+
+    def get_source_row_id(self, obj, primary_key_name):
+
+        # object can be a SourceRow object ( from database ) or a dict from API
+        if isinstance(obj, dict):
+            return obj.get(primary_key_name)
+        else:
+            return getattr(obj, primary_key_name)
+
+    # ----
+
+    def get_source_batches(self, pipeline, select_columns=None):
+
+        """ Generator of batches ( lists ) of source rows for given pipeline
+        
+            For database sources we use keyset pagination ( WHERE key > :last ORDER BY key LIMIT n ) 
+            so every batch has the same cost. Only for sources without a sortable key ( like views 
+            with a guessed key ) or when data_source['read_mode'] is 'offset' we page by offset.
+            With read_mode 'stream' we do one query over a server side cursor and cut it in batches
+        
+        :param pipeline: Gutter Pipeline instance
+        :param select_columns: only select these columns as tuples ( see get_select_columns )
+        :return: generator of lists with ORM rows or tuples ( database ) or dicts ( API )
+        
+        """
+
+        if pipeline.type == 'api':
+            if self.api_source is None:  # make sure it is here
+                self.api_source = ApiSource(pipeline.data_source)
+
+            if self.api_source.stream_rows:
+                # big responses: rows are parsed in batches while they come in
+                for source_rows_in_batch in self.api_source.iter_streamed_batches(self.BATCHSIZE):
+                    yield source_rows_in_batch
+
+                return
+
+            # next pages are fetched while the current one is synced ( see ApiSource.iter_batches )
+            for source_rows_in_batch in self.api_source.iter_batches():
+                yield source_rows_in_batch
+
+            return
+
+        # NOTE: table instance maintains its own database session of the source database
+        # important: don't use self.db_session since that is gutter db
+        source_table = pipeline.source_table
+        read_mode = (pipeline.data_source or {}).get('read_mode') or self.SOURCE_READ_MODE
+
+        if read_mode == 'keyset' and not source_table.has_sortable_key():
+            self.logger.warning("Source '{0}' has no unique sortable key: fall back to offset pagination".format(
+                source_table.name))
+            read_mode = 'offset'
+
+        self.logger.info("Read source '{0}' with {1} pagination".format(source_table.name, read_mode))
+
+        if read_mode == 'stream':
+            for source_rows_in_batch in source_table.get_streamed_batches(self.BATCHSIZE, select_columns):
+                yield source_rows_in_batch
+        elif read_mode == 'offset':
+            batch_num = 0
+            source_rows_in_batch = source_table.get_offset_batch(batch_num, self.BATCHSIZE, select_columns)
+
+            while len(source_rows_in_batch) != 0:
+                yield source_rows_in_batch
+                batch_num += 1
+                source_rows_in_batch = source_table.get_offset_batch(batch_num, self.BATCHSIZE, select_columns)
+        else:
+            source_rows_in_batch = source_table.get_keyset_batch(None, self.BATCHSIZE, select_columns)
+
+            while len(source_rows_in_batch) != 0:
+                last_key = source_table.get_key_value(source_rows_in_batch[-1])  # before sync touches the rows
+                yield source_rows_in_batch
+                source_rows_in_batch = source_table.get_keyset_batch(last_key, self.BATCHSIZE, select_columns)
+
+    # ----
+
+    def get_compiled_map(self, pipeline):
+
+        """
+            Compile the map of the pipeline with the JSON converters of its current source columns
+            transfer_data does this once at the start of every run ( source columns can change between runs )
+
+            :param pipeline: Pipeline instance with map
+            :return: dict -- compiled map ( see compile_map )
+
+        """
+
+        input_columns = None  # API data is a dict already
+
+        if pipeline.source_schema_definition is not None and pipeline.type != 'api':
+            input_columns = list(pipeline.source_schema_definition.get('properties', {}).keys())
+
+        compiled_map = self.compile_map(pipeline.map, input_columns)
+
+        # JSON converters per source column: picked once by type of column ( see map_data and map_batch )
+        if input_columns is not None:
+            source_columns = pipeline.source_table.columns if pipeline.source_table is not None else {}
+
+            compiled_map['converters'] = dict(
+                (column, JsonCoercer.get_converter(pipeline.source_schema_definition['properties'].get(column),
+                                                   source_columns.get(column, {}).get('type')))
+                for column in input_columns)
+
+        return compiled_map
+
+    # ----
+
+    def compile_map(self, map, input_columns=None):
+
+        """
+            Compile a source-to-target map: expressions are compiled to code objects,
+            so they don't have to be parsed again for every row
+
+            :param map: dict with output property names and input property names or expressions
+            :param input_columns: list of column names that make the input of expressions for source rows
+            :return: dict -- { properties : [ ( output_property, input_property, code, expression ) ], input_columns : list,
+                                columnar : boolean ( no expressions: map can be done per column ) }
+
+        """
+
+        properties = []
 
-        # maps the data from source object to storage object
         for output_property, map_value in map.items():
             # map value can be a simple name of input property or can contain python logic
             # Complex case: name : lower(name_input) or name : surname + ' ' + family_name 
 
             # TODO: check if output property ( is defined in target_schema_def of pipeline object
 
-            output = None
-
             if map_value is None:
                 self.logger.warning(
                     "No map value for output '{0}': Please check the given map! We default to None".format(
                         output_property))
-                output = None
+                properties.append((output_property, None, None, None))
             # simple mapping 'column name' : 'same_column name'
             elif output_property == map_value:
+                properties.append((output_property, map_value, None, None))
+            # rename 'column name' : 'other column name' or 'column name' : input['other column name']
+            elif input_columns is not None and map_value in input_columns:
+                properties.append((output_property, map_value, None, None))
+            elif isinstance(map_value, str) and MAP_INPUT_PROPERTY_PATTERN.match(map_value):
+                properties.append((output_property, MAP_INPUT_PROPERTY_PATTERN.match(map_value).group(2), None, None))
+            # complex value expression
+            else:
+                try:
+                    code = compile(map_value, '<map {0}>'.format(output_property), 'eval')
+                except Exception as e:
+                    self.logger.error(
+                        "failed to compile map_expression: {0}. Output is set to None! {1}".format(map_value, e))
+                    code = None
 
-                if type(source_obj) is dict:  # for data from API
-                    output = source_obj.get(map_value)
-                else:
-                    # DataRow input
-                    incoming_value = getattr(source_obj, map_value)
+                properties.append((output_property, None, code, map_value))
 
-                    output = incoming_value
-            # complex value expression
+        columnar = all(code is None and (input_property is None or input_columns is None or input_property in input_columns)
+                       for output_property, input_property, code, expression in properties)
+
+        return {'properties': properties, 'input_columns': input_columns, 'columnar': columnar}
+
+    # ----
+
+    def map_data(self, source_obj, storage_obj, map, compiled_map=None):
+
+        """
+            Map a source row to a storage row
+
+            :param source_obj: Can be a ORM Row instance or dict ( from API )
+            :param storage_obj: ORM GutterRow instance
+            :param map: source-to-target map, only used when no compiled_map is given
+            :param compiled_map: compiled map ( see get_compiled_map )
+            :return: dict -- the data in key,value pair dict
+        
+        """
+
+        if compiled_map is None:
+            compiled_map = self.compile_map(map)
+
+        json_data = {}  # on storage row object
+        input = None  # input of expressions: only made when needed
+
+        source_is_dict = type(source_obj) is dict  # for data from API
+        converters = compiled_map.get('converters') or {}
+
+        # maps the data from source object to storage object
+        for output_property, input_property, code, expression in compiled_map['properties']:
+
+            # IMPORTANT: FILTER - Make sure value types like decimals fit in JSON
+            # for columns the converter is known by their type, output of expressions can be anything
+            convert = JsonCoercer.to_json_value
+
+            if code is not None:
+                if input is None:
+                    input = self.get_map_input(source_obj, compiled_map['input_columns'])
+
+                output = self.eval_map_expression(input, expression, code)
+            elif input_property is None:
+                output = None  # no map value or failed expression
+            elif source_is_dict:
+                output = source_obj.get(input_property)
             else:
-                output = self.eval_map_expression(source_obj, map_value)  # map_value is an expression
+                output = getattr(source_obj, input_property)  # DataRow input
+                convert = converters.get(input_property, convert)
 
             # We are done for this property: output value is in output
-            # IMPORTANT: FILTER - Make sure value types like decimals fit in JSON
             try:
-                output = json.loads(json.dumps(output,
-                                               default=str))  # default is just a fall_back and serializes everything to a string
+                output = convert(output)
             except Exception as e:
                 self.logger.error("Error serializing property {0}={1}".format(output_property, output))
                 self.logger.error(e)
@@ -719,7 +1146,90 @@ class GutterFlow:
 
     # ----
 
-    def eval_map_expression(self, source_obj, map_expression):
+    def get_select_columns(self, pipeline, compiled_map, primary_key_name):
+
+        """
+            Columns to select from the source when the map can be done per column ( only 1:1 or rename maps )
+            Then the source rows are fetched as tuples instead of ORM objects
+
+            :return: list of column names or None -- None when rows are needed as ORM objects
+
+        """
+
+        if pipeline.type == 'api' or not compiled_map.get('columnar') or compiled_map.get('input_columns') is None:
+            return None
+
+        key_column = pipeline.source_table.get_key_column()
+
+        if key_column is None:
+            return None
+
+        select_columns = [primary_key_name, key_column.key] + [input_property for output_property, input_property, code, expression
+                                                               in compiled_map['properties'] if input_property is not None]
+
+        return list(OrderedDict.fromkeys(select_columns))  # unique in order
+
+    # ----
+
+    def map_batch(self, source_rows, primary_key_name, compiled_map, select_columns=None):
+
+        """
+            Map a batch of source rows to ( id, data ) pairs
+
+            With select_columns the rows are tuples of these columns: the values are converted per column 
+            with the converters of the compiled map and the data dicts are made in one pass over the batch.
+            Otherwise every row is mapped by map_data
+
+            :param source_rows: list of ORM rows, dicts ( API ) or tuples ( select_columns )
+            :param primary_key_name: name of the key property in the source
+            :param compiled_map: compiled map ( see get_compiled_map )
+            :param select_columns: names of the columns in the tuples ( see get_select_columns )
+            :return: list of ( id, data dict ) tuples
+
+        """
+
+        if select_columns is None:
+            return [(self.get_source_row_id(obj, primary_key_name), self.map_data(obj, None, None, compiled_map))
+                    for obj in source_rows]
+
+        if len(source_rows) == 0:
+            return []
+
+        columns = list(zip(*source_rows))  # values per column
+        converters = compiled_map['converters']
+
+        output_properties = []
+        output_columns = []
+
+        for output_property, input_property, code, expression in compiled_map['properties']:
+            output_properties.append(output_property)
+
+            if input_property is None:
+                output_columns.append([None] * len(source_rows))
+            else:
+                convert = converters[input_property]
+                output_columns.append([convert(value) for value in columns[select_columns.index(input_property)]])
+
+        ids = columns[select_columns.index(primary_key_name)]
+
+        return [(id, dict(zip(output_properties, values))) for id, values in zip(ids, zip(*output_columns))]
+
+    # ----
+
+    def get_map_input(self, source_obj, input_columns=None):
+
+        # NOTE: source_obj can be source_row or dict ( dict is coming from api )
+        if type(source_obj) is dict:
+            return source_obj
+
+        if input_columns is None:
+            input_columns = [column.key for column in inspect(type(source_obj)).columns]
+
+        return dict((column, getattr(source_obj, column)) for column in input_columns)
+
+    # ----
+
+    def eval_map_expression(self, input, map_expression, code=None):
 
         """
             We allow for python code to run as part of the mapping process ( for example to enrich the data )
@@ -727,13 +1237,13 @@ class GutterFlow:
             NOTES: 
                 - expressions are strings from defined datamap object in database
                 - expressions use "input" as reference to incoming data_row or data_dict 
-                - For example: input.<<input column>> 
-                    or we can use python logic:  input['col1'] + input['col2'], or access subfields: input['col1']['key']
+                - For example: input['col1'] + input['col2'], or access subfields: input['col1']['key']
                 -  afterwards it is evaluated as python object code with eval
             WARNING: Don't use " in expression because it messes up the JSON
             
-            :param source_obj: SourceRow instance or dict with data
+            :param input: dict with data of the source row ( see get_map_input )
             :param map_expression: the complex expression mapping the input to output
+            :param code: compiled map_expression ( see compile_map )
             :return: data value or None -- Can be numeric or string 
         
         """
@@ -742,21 +1252,9 @@ class GutterFlow:
             self.logger.error("Empty expression in map")
             return None
 
-        # NOTE: source_obj can be source_row or dict ( dict is coming from api )
-
-        # set up the input as a dict
-        if type(source_obj) is dict:
-            prop_names = source_obj.keys()
-            prop_values = source_obj.values()
-        else:
-            prop_names = source_obj.get_props()  # NOTE: this can be unstable when there is a unknown data type in source
-            prop_values = [getattr(source_obj, p) for p in prop_names]  # all strings
-
-        input = dict(zip(prop_names, prop_values))
-
         try:
-            output = eval(map_expression)  # !!!! TODO: evaluate security !!!!
-            self.logger.info(
+            output = eval(code or map_expression, globals(), {'input': input})  # !!!! TODO: evaluate security !!!!
+            self.logger.debug(
                 "Succesfully evaluated map_expression: '{0}' to value '{1}'".format(map_expression, output))
             return output
         except Exception as e:
@@ -0,0 +1,255 @@
+"""
+
+    JobQueue.py
+
+    * Queue of pipeline jobs in the gutter database ( table gutter.pipeline_jobs )
+    * Runners claim jobs with SELECT ... FOR UPDATE SKIP LOCKED: many runners ( processes or nodes )
+      can share the work without executing a pipeline twice
+    * A claimed job has a lease that the worker extends with heartbeats. Jobs with an expired lease
+      ( runner or worker died ) can be claimed again. A worker that lost its lease stops its job
+    * All times are taken from the database ( now() ): the clocks of the runners don't matter
+
+"""
+
+from sqlalchemy import text
+
+import threading
+import logging
+import socket
+import uuid
+import os
+
+from .PipelineJob import PipelineJob
+
+
+class JobQueue:
+
+    def __init__(self, db_engine, runner_id=None):
+
+        """
+        :param db_engine: SQLAlchemy engine of gutter database
+        :param runner_id: id of runner that claims jobs, default: <<host>>:<<pid>>:<<random>>
+
+        """
+
+        # settings
+        self.LEASE_SECONDS = 60  # a job is given up when there is no heartbeat for this long
+        self.HEARTBEAT_SECONDS = 20
+        self.MAX_ATTEMPTS = 3  # jobs with expired leases are claimed again until this number of attempts
+        self.KEEP_FINISHED_DAYS = 7
+
+        # properties
+        self.db_engine = db_engine
+        self.runner_id = runner_id or JobQueue.make_runner_id()
+
+        self.logger = logging.getLogger(__name__)
+
+    # ----
+
+    @staticmethod
+    def make_runner_id():
+
+        return '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+    # ----
+
+    def create_table(self):
+
+        return PipelineJob().create_table(self.db_engine)
+
+    # ----
+
+    def enqueue(self, pipeline):
+
+        """ Add a job for pipeline: only when the pipeline has no queued or running job yet
+
+        :param pipeline: Pipeline instance
+        :return: id of new job or None --
+
+        """
+
+        sql = """
+            INSERT INTO gutter.pipeline_jobs (pipeline_id, pipeline_name, status, created_at, attempts)
+            VALUES (:pipeline_id, :pipeline_name, 'queued', now(), 0)
+            ON CONFLICT (pipeline_id) WHERE status IN ('queued', 'running') DO NOTHING
+            RETURNING id
+        """
+
+        try:
+            with self.db_engine.begin() as connection:
+                return connection.execute(text(sql), {'pipeline_id': pipeline.id,
+                                                      'pipeline_name': pipeline.name}).scalar()
+        except Exception as e:
+            self.logger.error("Could not enqueue pipeline '{0}': {1}".format(pipeline.name, e))
+            return None
+
+    # ----
+
+    def claim(self):
+
+        """ Claim the oldest queued job ( or a running job with expired lease ) for this runner
+            Rows that other runners are claiming at the same time are skipped, not waited for
+
+        :return: dict { id, pipeline_id, pipeline_name, attempts } or None --
+
+        """
+
+        sql = """
+            UPDATE gutter.pipeline_jobs AS j
+            SET status = 'running', claimed_by = :runner_id, claimed_at = now(), heartbeat_at = now(),
+                lease_until = now() + make_interval(secs => :lease_seconds), attempts = j.attempts + 1
+            WHERE j.id = (
+                SELECT id FROM gutter.pipeline_jobs
+                WHERE status = 'queued' OR (status = 'running' AND lease_until < now())
+                ORDER BY created_at
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING j.id, j.pipeline_id, j.pipeline_name, j.attempts
+        """
+
+        try:
+            with self.db_engine.begin() as connection:
+                self.fail_exhausted_jobs(connection)
+
+                row = connection.execute(text(sql), {'runner_id': self.runner_id,
+                                                     'lease_seconds': self.LEASE_SECONDS}).fetchone()
+        except Exception as e:
+            self.logger.error("Could not claim job: {0}".format(e))
+            return None
+
+        if row is None:
+            return None
+
+        return {'id': row['id'], 'pipeline_id': row['pipeline_id'], 'pipeline_name': row['pipeline_name'],
+                'attempts': row['attempts']}
+
+    # ----
+
+    def fail_exhausted_jobs(self, connection):
+
+        # jobs with expired leases that were tried too often are not claimed again
+        sql = """
+            UPDATE gutter.pipeline_jobs
+            SET status = 'failed', finished_at = now(), error = 'lease expired after ' || attempts || ' attempts'
+            WHERE status = 'running' AND lease_until < now() AND attempts >= :max_attempts
+        """
+
+        connection.execute(text(sql), {'max_attempts': self.MAX_ATTEMPTS})
+
+    # ----
+
+    def heartbeat(self, job_id):
+
+        """ Extend the lease of a claimed job
+
+        :return: bool or None -- False when this runner does not hold the job anymore, None when the heartbeat failed
+
+        """
+
+        sql = """
+            UPDATE gutter.pipeline_jobs
+            SET heartbeat_at = now(), lease_until = now() + make_interval(secs => :lease_seconds)
+            WHERE id = :job_id AND claimed_by = :runner_id AND status = 'running'
+        """
+
+        try:
+            with self.db_engine.begin() as connection:
+                result = connection.execute(text(sql), {'job_id': job_id, 'runner_id': self.runner_id,
+                                                        'lease_seconds': self.LEASE_SECONDS})
+                return result.rowcount == 1
+        except Exception as e:
+            self.logger.error("Heartbeat of job {0} failed: {1}".format(job_id, e))
+            return None  # try again with the next heartbeat: the lease is longer than the heartbeat interval
+
+    # ----
+
+    def start_heartbeat(self, job_id, lost_lease=None):
+
+        """ Send heartbeats for job in a background thread until the returned event is set
+            When the lease is lost ( another runner claimed the job ) the heartbeats stop and lost_lease is set:
+            the worker has to stop the job ( see GutterFlow.cancel_event )
+
+        :param lost_lease: threading.Event that is set when this runner does not hold the job anymore
+        :return: threading.Event -- set it to stop the heartbeats
+
+        """
+
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.HEARTBEAT_SECONDS):
+                if self.heartbeat(job_id) is False:
+                    self.logger.error("Lost lease of job {0}: stop the job".format(job_id))
+
+                    if lost_lease is not None:
+                        lost_lease.set()
+
+                    return
+
+        threading.Thread(target=beat, name='gutter_heartbeat_{0}'.format(job_id), daemon=True).start()
+
+        return stop
+
+    # ----
+
+    def finish(self, job_id, success, error=None):
+
+        """ Mark claimed job as done or failed
+
+        :return: bool -- False when this runner does not hold the job anymore
+
+        """
+
+        sql = """
+            UPDATE gutter.pipeline_jobs
+            SET status = :status, finished_at = now(), lease_until = NULL, error = :error
+            WHERE id = :job_id AND claimed_by = :runner_id AND status = 'running'
+        """
+
+        try:
+            with self.db_engine.begin() as connection:
+                result = connection.execute(text(sql), {'job_id': job_id, 'runner_id': self.runner_id,
+                                                        'status': 'done' if success else 'failed',
+                                                        'error': error})
+                return result.rowcount == 1
+        except Exception as e:
+            self.logger.error("Could not finish job {0}: {1}".format(job_id, e))
+            return False
+
+    # ----
+
+    def release(self, job_id):
+
+        """ Put a claimed job that did not start back in the queue ( for example on shutdown )
+
+        """
+
+        sql = """
+            UPDATE gutter.pipeline_jobs
+            SET status = 'queued', claimed_by = NULL, claimed_at = NULL, lease_until = NULL, attempts = attempts - 1
+            WHERE id = :job_id AND claimed_by = :runner_id AND status = 'running'
+        """
+
+        try:
+            with self.db_engine.begin() as connection:
+                return connection.execute(text(sql), {'job_id': job_id, 'runner_id': self.runner_id}).rowcount == 1
+        except Exception as e:
+            self.logger.error("Could not release job {0}: {1}".format(job_id, e))
+            return False
+
+    # ----
+
+    def purge_finished_jobs(self):
+
+        sql = """
+            DELETE FROM gutter.pipeline_jobs
+            WHERE status IN ('done', 'failed') AND finished_at < now() - make_interval(days => :days)
+        """
+
+        try:
+            with self.db_engine.begin() as connection:
+                return connection.execute(text(sql), {'days': self.KEEP_FINISHED_DAYS}).rowcount
+        except Exception as e:
+            self.logger.error("Could not purge finished jobs: {0}".format(e))
+            return 0
@@ -0,0 +1,207 @@
+"""
+
+    JsonCoercer.py
+
+    * Converts values from source rows to values that fit in JSON ( the data column of gutter tables )
+
+"""
+
+import base64
+import datetime
+import math
+import uuid
+
+from decimal import Decimal
+
+import simplejson as json
+
+BINARY_COLUMN_TYPES = ['BYTEA', 'BLOB', 'RAW', 'LONG RAW', 'BINARY', 'VARBINARY', 'LargeBinary']
+
+
+class JsonCoercer:
+
+    @staticmethod
+    def to_json_value(value):
+
+        """ Convert any value to a JSON value without serializing it: 
+            decimals become numbers, dates and times strings, bytes base64 strings and containers are converted per item
+            Unknown types fall back to a JSON round trip where everything JSON does not know is serialized to a string
+
+        :param value: any value
+        :return: JSON value --
+
+        """
+
+        convert = TYPE_CONVERTERS.get(type(value))
+
+        if convert is not None:
+            return convert(value)
+
+        return JsonCoercer.serialize(value)
+
+    # ----
+
+    @staticmethod
+    def serialize(value):
+
+        return json.loads(json.dumps(value, default=str))  # default is just a fall_back and serializes everything to a string
+
+    # ----
+
+    @staticmethod
+    def get_converter(property_def=None, column_type=None):
+
+        """ Get a converter function for the values of one column, based on its JSON schema property definition
+            and the type of the column in the source database ( see Table.columns )
+            This is done once per column: the converters skip the checks that are not needed for the type
+
+        :param property_def: JSON schema property definition ( like { type: 'string', format: 'date-time' } )
+        :param column_type: name of type of column in source database
+        :return: function -- value in, JSON value out
+
+        """
+
+        property_def = property_def or {}
+
+        prop_type = property_def.get('type')
+        prop_format = property_def.get('format')
+
+        if column_type in BINARY_COLUMN_TYPES:
+            return JsonCoercer.convert_binary
+        elif prop_type == 'integer':
+            return JsonCoercer.convert_integer
+        elif prop_type == 'number':
+            return JsonCoercer.convert_number
+        elif prop_type == 'string' and prop_format in ['date-time', 'date_time']:
+            return JsonCoercer.convert_datetime
+        elif prop_type == 'string':
+            return JsonCoercer.convert_string
+        else:
+            return JsonCoercer.to_json_value
+
+    # ----
+
+    @staticmethod
+    def convert_integer(value):
+
+        if value is None or type(value) is int:
+            return value
+
+        return JsonCoercer.to_json_value(value)
+
+    # ----
+
+    @staticmethod
+    def convert_number(value):
+
+        if value is None or type(value) is int:
+            return value
+        elif type(value) is Decimal:
+            return JsonCoercer.convert_decimal(value)
+        elif type(value) is float:
+            return JsonCoercer.convert_float(value)
+
+        return JsonCoercer.to_json_value(value)
+
+    # ----
+
+    @staticmethod
+    def convert_datetime(value):
+
+        if value is None or type(value) is str:
+            return value
+        elif type(value) in (datetime.datetime, datetime.date):
+            return str(value)  # NOTE: same format as before: 'YYYY-MM-DD HH:MM:SS'
+
+        return JsonCoercer.to_json_value(value)
+
+    # ----
+
+    @staticmethod
+    def convert_string(value):
+
+        if value is None or type(value) is str:
+            return value
+
+        return JsonCoercer.to_json_value(value)
+
+    # ----
+
+    @staticmethod
+    def convert_binary(value):
+
+        if value is None:
+            return value
+
+        return base64.b64encode(bytes(value)).decode('ascii')
+
+    # ----
+
+    @staticmethod
+    def convert_decimal(value):
+
+        # like the JSON round trip: integer when the decimal has no exponent ( 5 ), otherwise float ( 5.0 )
+        if not value.is_finite():
+            return None  # NaN and Infinity are not JSON
+
+        if value.as_tuple().exponent == 0:
+            return int(value)
+
+        return float(value)
+
+    # ----
+
+    @staticmethod
+    def convert_float(value):
+
+        if math.isnan(value) or math.isinf(value):
+            return None  # not JSON
+
+        return value
+
+    # ----
+
+    @staticmethod
+    def convert_dict(value):
+
+        # JSON keys are strings: other keys are serialized like json.dumps does ( 1 => '1', None => 'null' )
+        return dict((key if type(key) is str else JsonCoercer.convert_key(key), JsonCoercer.to_json_value(item))
+                    for key, item in value.items())
+
+    # ----
+
+    @staticmethod
+    def convert_key(key):
+
+        try:
+            return json.dumps(key)
+        except Exception:
+            return str(key)
+
+    # ----
+
+    @staticmethod
+    def convert_list(value):
+
+        return [JsonCoercer.to_json_value(item) for item in value]
+
+
+# converters by exact type of value: other types ( like subclasses ) are serialized
+TYPE_CONVERTERS = {
+    type(None): lambda value: value,
+    bool: lambda value: value,
+    int: lambda value: value,
+    str: lambda value: value,
+    float: JsonCoercer.convert_float,
+    Decimal: JsonCoercer.convert_decimal,
+    datetime.datetime: str,
+    datetime.date: str,
+    datetime.time: str,
+    uuid.UUID: str,
+    bytes: JsonCoercer.convert_binary,
+    bytearray: JsonCoercer.convert_binary,
+    memoryview: JsonCoercer.convert_binary,
+    dict: JsonCoercer.convert_dict,
+    list: JsonCoercer.convert_list,
+    tuple: JsonCoercer.convert_list,
+}
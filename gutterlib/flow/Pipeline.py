@@ -6,6 +6,8 @@ from sqlalchemy.dialects.postgresql import JSONB
 import datetime
 import logging
 
+from .Scheduler import Scheduler
+
 db_obj = declarative_base()
 
 
@@ -28,12 +30,15 @@ class Pipeline(db_obj):
     executing = Column(Boolean())
     max_duration = Column(Integer())
     last_duration = Column(Integer())
+    watermark_column = Column(String(255))  # delta sync: only rows with a higher value than last_watermark
+    last_watermark = Column(String(255))
+    page_validators = Column(JSONB())  # api: { url : { etag, last_modified, num_rows } } of last successful run
 
     # ----
 
     def __init__(self, name, type, data_source, map_source_target=None,
                  primary_key=None, last_run=None, last_source_schema_def=None, last_automap=None, run_at=None,
-                 executing=None):
+                 executing=None, watermark_column=None):
 
         self.id = None  # auto
         self.name = name
@@ -46,12 +51,16 @@ class Pipeline(db_obj):
         self.last_automap = last_automap
         self.run_at = run_at
         self.executing = False
+        self.watermark_column = watermark_column
+        self.last_watermark = None
+        self.page_validators = None
 
         # non_db properties
         self.source_schema_definition = None
         self.source_model = None
         self.source_table = None
         self.map = None
+        self.next_watermark = None  # watermark of current run: saved in last_watermark when run succeeds
 
         self.create_logger()
 
@@ -66,7 +75,9 @@ class Pipeline(db_obj):
 
         self.source_schema_definition = None
         self.source_model = None
+        self.source_table = None
         self.map = None
+        self.next_watermark = None
 
         self.create_logger()
 
@@ -143,11 +154,14 @@ class Pipeline(db_obj):
 
     # ----
 
-    def needs_doing(self, time_obj=None):
+    def needs_doing(self, fire_time=None, time_obj=None):
 
         """ Check if this pipeline needs to be executed
             
-            :param time_obj:  { type: every|at, hour: 4 or minutes: 5 }
+            :param fire_time: datetime this pipeline was scheduled for ( see Scheduler.pop_due ): the schedule is trusted 
+                              and not computed again, otherwise a late check would move the fire time to the next one
+            :param time_obj:  { type: every|at|cron, hour: 4 or minutes: 5 or cron: '0 4 * * *' } ( see Scheduler )
+                              only used without fire_time
             :return: bool --
         
         """
@@ -155,7 +169,7 @@ class Pipeline(db_obj):
         if time_obj is None:
             time_obj = self.run_at
 
-        if time_obj is None:
+        if time_obj is None and fire_time is None:
             # self.logger.error("we need a time_obj to check if we need to do the job!")
             return False
 
@@ -171,38 +185,13 @@ class Pipeline(db_obj):
                 self.logger.info("This pipeline was run under a minute ago!")
                 return False
 
-        timing_type = time_obj.get('type')
-
-        if timing_type == "at":  # by time
-            try:
-                hour = int(time_obj.get('hour'))
-
-                if not hour:
-                    # self.logger.error("please supply the hour you want to run the job")
-                    return False
-
-                if now.hour == hour and now.minute == 0:
-                    # on rounded hour: <<hour>>:00h ex: 4:00
-                    return True
-            except Exception as e:
-                # self.logger.error("failed to parse 'at' timing object!")
-                return False
-
-        elif timing_type == "every":  # every x minutes
-
-            try:
-                minutes = int(time_obj.get('minutes'))
+        if fire_time is not None:
+            return fire_time <= now
 
-                if not minutes:
-                    # self.logger.error("please supply the minutes in the time_obj")
-                    return False
-                if self.run_at is None:
-                    return True  # just run
-                elif ((now - self.last_run).total_seconds() / 60.0) >= minutes:
-                    return True
-
-            except Exception as e:
-                # self.logger.error("failed to parse 'every' timing object!")
-                return False
+        try:
+            fire_time = Scheduler.get_next_fire_time(time_obj, self.last_run, now)
+        except Exception as e:
+            self.logger.error("failed to parse timing object: {0}".format(e))
+            return False
 
-        return False
+        return fire_time is not None and fire_time <= now
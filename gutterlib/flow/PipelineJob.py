@@ -0,0 +1,58 @@
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, Integer, String, DateTime, Text, Index, text
+
+import logging
+
+db_obj = declarative_base()
+
+
+class PipelineJob(db_obj):
+
+    """ Execution of a pipeline in the job queue ( see JobQueue )
+
+        A runner claims a queued job and holds a lease on it that its worker extends with heartbeats.
+        When the lease expires ( runner died ) another runner can claim the job again
+
+    """
+
+    __tablename__ = 'pipeline_jobs'
+    __table_args__ = (Index('pipeline_jobs_active_pipeline_idx', 'pipeline_id', unique=True,
+                            postgresql_where=text("status IN ('queued', 'running')")),  # one active job per pipeline
+                      Index('pipeline_jobs_status_idx', 'status', 'created_at'),
+                      {"schema": "gutter"})
+
+    id = Column(Integer, primary_key=True)
+    pipeline_id = Column(Integer())
+    pipeline_name = Column(String(255))
+    status = Column(String(20))  # queued, running, done or failed
+    created_at = Column(DateTime)
+    claimed_by = Column(String(255))  # id of runner
+    claimed_at = Column(DateTime)
+    lease_until = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    attempts = Column(Integer())
+    error = Column(Text())
+
+    # ----
+
+    def __repr__(self):
+        # string/unicode representation of object
+        return "<PipelineJob id='{0}', pipeline_name='{1}', status='{2}', claimed_by='{3}', lease_until='{4}'>".format(
+            self.id, self.pipeline_name, self.status, self.claimed_by, self.lease_until)
+
+    # ----
+
+    def create_table(self, engine):
+
+        if not engine:
+            logging.getLogger(__name__).error('Cannot create_table: please supply engine!')
+            return False
+
+        try:
+            db_obj.metadata.create_all(engine, tables=[self.__table__])
+            return True
+
+        except Exception as e:
+            logging.getLogger(__name__).error("Can't create table for pipeline jobs: {0}".format(e))
+            return False
@@ -0,0 +1,172 @@
+"""
+
+    Scheduler.py
+
+    * Computes the next fire time of pipelines from their run_at definition:
+        - { type: 'every', minutes: 5 }
+        - { type: 'at', hour: 4, minute: 30 } ( minute is optional )
+        - { type: 'cron', cron: '*/15 6-18 * * 1-5' }
+    * Keeps a heap of fire times so the runner can sleep until the next pipeline is due
+    * Catch up: a fire time that was missed ( runner was down ) fires once directly.
+      Set run_at['catch_up'] to false to skip missed runs
+    * A pipeline that never ran: 'every' is due directly, 'at' and 'cron' wait for their next fire time
+    * The runner trusts the fire times it pops: they are not computed again when they are due ( see Pipeline.needs_doing )
+
+"""
+
+import datetime
+import logging
+import heapq
+
+from .CronExpression import CronExpression
+
+MISSED_GRACE_SECONDS = 60  # without catch up: fire times this late still fire
+
+
+class Scheduler:
+
+    def __init__(self):
+
+        # properties
+        self.heap = []  # ( fire_time, pipeline_id, pipeline_name )
+        self.fire_times = {}  # pipeline_id : fire_time, only the entries in the heap with these times are valid
+        self.last_reload = None
+
+        self.logger = logging.getLogger(__name__)
+
+    # ----
+
+    @staticmethod
+    def get_next_fire_time(run_at, last_run=None, now=None):
+
+        """ Get the time a pipeline needs to run next
+
+        :param run_at: run_at definition of pipeline
+        :param last_run: datetime of last run of pipeline ( None when never run )
+        :param now: datetime, default now
+        :return: datetime or None -- when never to run. Can be in the past: then the pipeline is due
+        :raises ValueError: when run_at is not valid
+
+        """
+
+        if not run_at:
+            return None
+
+        now = now or datetime.datetime.now()
+        timing_type = run_at.get('type')
+
+        if timing_type == 'every':
+            minutes = float(run_at.get('minutes') or 0)
+
+            if minutes <= 0:
+                raise ValueError("please supply the minutes in the run_at object")
+
+            if last_run is None:
+                return now  # just run
+
+            fire_time = last_run + datetime.timedelta(minutes=minutes)
+
+        elif timing_type in ['at', 'cron']:
+            if timing_type == 'at':
+                cron = CronExpression('{0} {1} * * *'.format(int(run_at.get('minute') or 0), int(run_at.get('hour'))))
+            else:
+                cron = CronExpression(run_at.get('cron') or '')
+
+            fire_time = cron.get_next(last_run or now)
+
+            # catch up: missed fire times since last run result in one run now
+            if fire_time is not None and fire_time < now and run_at.get('catch_up', True) is False:
+                if (now - fire_time).total_seconds() > MISSED_GRACE_SECONDS:
+                    # skip the missed runs, but not the one that is due right now ( within the grace )
+                    fire_time = cron.get_next(now - datetime.timedelta(seconds=MISSED_GRACE_SECONDS))
+        else:
+            raise ValueError("unknown run_at type '{0}'".format(timing_type))
+
+        return fire_time
+
+    # ----
+
+    def reload(self, pipelines, now=None):
+
+        """ (Re)build the schedule for given pipelines ( for example after changes in the database )
+
+        :param pipelines: list of Pipeline instances
+
+        """
+
+        self.heap = []
+        self.fire_times = {}
+        self.last_reload = now or datetime.datetime.now()
+
+        for pipeline in pipelines:
+            self.schedule(pipeline.id, pipeline.name, pipeline.run_at, pipeline.last_run, now)
+
+    # ----
+
+    def schedule(self, pipeline_id, pipeline_name, run_at, last_run=None, now=None):
+
+        """ Schedule the next run of a pipeline ( replaces earlier schedule of this pipeline )
+
+        :return: datetime or None -- fire time
+
+        """
+
+        try:
+            fire_time = Scheduler.get_next_fire_time(run_at, last_run, now)
+        except Exception as e:
+            self.logger.error("Invalid run_at of pipeline '{0}': {1}".format(pipeline_name, e))
+            fire_time = None
+
+        if fire_time is None:
+            self.fire_times.pop(pipeline_id, None)
+            return None
+
+        self.fire_times[pipeline_id] = fire_time
+        heapq.heappush(self.heap, (fire_time, pipeline_id, pipeline_name))
+
+        return fire_time
+
+    # ----
+
+    def pop_due(self, now=None):
+
+        """ Take the pipelines that are due off the schedule
+
+        :return: list of ( pipeline_id, pipeline_name, fire_time ) --
+
+        """
+
+        now = now or datetime.datetime.now()
+        due = []
+
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            fire_time, pipeline_id, pipeline_name = heapq.heappop(self.heap)
+
+            if self.fire_times.get(pipeline_id) != fire_time:
+                continue  # replaced by later schedule
+
+            del self.fire_times[pipeline_id]
+            due.append((pipeline_id, pipeline_name, fire_time))
+
+        return due
+
+    # ----
+
+    def get_seconds_until_next(self, now=None):
+
+        """ Seconds until the next pipeline is due
+
+        :return: float or None -- None when nothing is scheduled
+
+        """
+
+        now = now or datetime.datetime.now()
+
+        # drop replaced entries
+        while len(self.heap) > 0 and self.fire_times.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+        if len(self.heap) == 0:
+            return None
+
+        return max(0.0, (self.heap[0][0] - now).total_seconds())
@@ -5,11 +5,14 @@ created on 29 mei 2018
 '''
 
 import re
+import copy
 import datetime
+import itertools
+import threading
+from collections import OrderedDict
 
 from sqlalchemy.schema import MetaData
-from sqlalchemy.engine.reflection import Inspector
-from sqlalchemy import inspect
+from sqlalchemy import inspect, select, literal, func, text
 from sqlalchemy.schema import Table as SQLAlchemyTable
 
 from sqlalchemy import Column as SQLAColumn, Integer as SQLAInteger, String as SQLAString, Numeric as SQLANumeric, \
@@ -23,6 +26,37 @@ from decimal import Decimal
 
 import logging
 
+# reflected tables by ( connection string, schema, name, with_descriptions ) : { fingerprint, columns, metadata, sqla_table }
+# bounded like the ModelRegistry: the least recently used tables are evicted
+REFLECTION_CACHE = OrderedDict()
+REFLECTION_CACHE_LOCK = threading.Lock()
+REFLECTION_CACHE_MAX_SIZE = 256
+
+# cheap queries that change when the columns of a table change ( parameters schema and name )
+# NOTE: no group_concat for mysql: it is cut off at group_concat_max_len ( 1024 bytes ) for wide tables
+FINGERPRINT_SQLS = {
+    'postgres': """
+        SELECT md5(string_agg(a.attname || ':' || format_type(a.atttypid, a.atttypmod) || ':' || a.attnotnull, ',' 
+                              ORDER BY a.attnum) || 
+                   coalesce((SELECT string_agg(conname || ':' || conkey::text, ',' ORDER BY conname) 
+                             FROM pg_constraint WHERE conrelid = c.oid AND contype = 'p'), ''))
+        FROM pg_class c 
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+        WHERE n.nspname = :schema AND c.relname = :name
+        GROUP BY c.oid
+    """,
+    'oracle': """
+        SELECT to_char(last_ddl_time, 'YYYY-MM-DD HH24:MI:SS') FROM all_objects 
+        WHERE owner = upper(:schema) AND object_name = upper(:name) AND object_type IN ('TABLE', 'VIEW')
+    """,
+    'mysql': """
+        SELECT concat(count(*), ':', max(ordinal_position), ':', 
+                      sum(crc32(concat_ws(':', ordinal_position, column_name, column_type, is_nullable, column_key))))
+        FROM information_schema.columns WHERE table_schema = :schema AND table_name = :name
+    """
+}
+
 
 class Table:
 
@@ -33,11 +67,13 @@ class Table:
         self.columns = {}  # name : { type ( type in db ), description, primary }
         self.schema = schema  # note: distinction between schema of database and json schema
         self.metadata = None
+        self.sqla_table = None  # reflected SQLAlchemy table
 
         self.schema_definition = None  # json schema generated from table structure and content
         self.primary_key = None
         self.model_class = None  # a SQLAlchemy ORM model class definition
         self.session = None
+        self.watermark = None  # ( column name, last value, max value ): only read these rows ( see set_watermark )
 
         self.create_logger()
 
@@ -93,11 +129,29 @@ class Table:
             if self.schema is None:
                 return []  # return empty list
 
-            # find out columns
-            self.metadata = MetaData(bind=self.database.engine, reflect=True, schema=self.schema)
-            sqla_table = SQLAlchemyTable(self.name, self.metadata, autoload=True, autoload_with=self.database.engine)
-            insp = Inspector.from_engine(self.database.engine)
-            insp.reflecttable(sqla_table, None)
+            # reflection of big schemas is slow: reuse it as long as the table did not change
+            cache_key = (self.database.connection_string, self.schema, self.name, with_descriptions)
+            fingerprint = self.get_fingerprint()
+
+            if fingerprint is not None:
+                with REFLECTION_CACHE_LOCK:
+                    cached = REFLECTION_CACHE.get(cache_key)
+
+                    if cached is not None:
+                        REFLECTION_CACHE.move_to_end(cache_key)
+
+                if cached is not None and cached['fingerprint'] == fingerprint:
+                    self.metadata = cached['metadata']
+                    self.sqla_table = cached['sqla_table']
+                    self.columns = copy.deepcopy(cached['columns'])
+
+                    return self.columns
+
+            # find out columns: only reflect this table or view, not the whole schema or the tables it refers to
+            self.metadata = MetaData(schema=self.schema)
+            sqla_table = SQLAlchemyTable(self.name, self.metadata, autoload=True, autoload_with=self.database.engine,
+                                         resolve_fks=False)
+            self.sqla_table = sqla_table
 
             descriptions = {}
 
@@ -108,7 +162,17 @@ class Table:
             for c in sqla_table.columns:
                 self.columns[c.name] = {'type': self.SQLA_column_type_to_string(c.type),
                                         'description': descriptions.get(c.name),
-                                        'primary': self.probably_is_primary_key(c)}
+                                        'primary': self.probably_is_primary_key(c),
+                                        'reflected_primary': bool(c.primary_key)}  # only real constraints, not guesses
+
+            if fingerprint is not None:
+                with REFLECTION_CACHE_LOCK:
+                    REFLECTION_CACHE[cache_key] = {'fingerprint': fingerprint, 'columns': copy.deepcopy(self.columns),
+                                                   'metadata': self.metadata, 'sqla_table': self.sqla_table}
+                    REFLECTION_CACHE.move_to_end(cache_key)
+
+                    while len(REFLECTION_CACHE) > REFLECTION_CACHE_MAX_SIZE:
+                        REFLECTION_CACHE.popitem(last=False)
 
             return self.columns
 
@@ -118,6 +182,35 @@ class Table:
 
     # ----
 
+    def get_fingerprint(self):
+
+        """ Get a value that changes when the columns ( or primary key ) of the table change
+            One cheap catalog query instead of reflecting the table
+        
+        :returns: str or None -- None when there is no fingerprint query for this type of database or the table is not found
+        
+        """
+
+        sql = None
+
+        for db_type, fingerprint_sql in FINGERPRINT_SQLS.items():
+            if db_type in (self.database.db_type or ''):
+                sql = fingerprint_sql
+                break
+
+        if sql is None:
+            return None
+
+        try:
+            fingerprint = self.database.engine.execute(text(sql), {'schema': self.schema, 'name': self.name}).scalar()
+        except Exception as e:
+            self.logger.warning("Cannot get fingerprint of table '{0}.{1}': {2}".format(self.schema, self.name, e))
+            return None
+
+        return str(fingerprint) if fingerprint is not None else None
+
+    # ----
+
     def SQLA_column_type_to_string(self, SQLA_column_type):
 
         """ SQL alchemy defines type in a class definition: make sure this is a string
@@ -542,11 +635,294 @@ class Table:
             self.logger.error("could not start query for table '{0}'".format(self.name))
             return False
 
+        key_column = self.get_key_column()
+
+        if key_column is None:
+            self.logger.error("could not start query for table '{0}': no key column to order on".format(self.name))
+            return False
+
         query = self.session.query(self.model_class).order_by(
-            self.model_class.id)  # NOTE: we force ordering on id for stability
+            key_column)  # NOTE: we force ordering on the key for stability
+
+        for watermark_filter in self.get_watermark_filters():
+            query = query.filter(watermark_filter)
 
         return query  # needs to be finished with all() or first() and limit() etc
 
+    # ----
+
+    def start_select(self, columns):
+
+        """ Core select of only the given columns, ordered on the key like start_query
+            The rows come back as plain tuples: no ORM objects are made for them
+        
+        :param columns: list of column names
+        :returns: SQLAlchemy Select or False --
+        
+        """
+
+        key_column = self.get_key_column()
+
+        if key_column is None:
+            self.logger.error("could not start select for table '{0}': no key column to order on".format(self.name))
+            return False
+
+        query = select([getattr(self.model_class, column) for column in columns]).order_by(key_column)
+
+        for watermark_filter in self.get_watermark_filters():
+            query = query.where(watermark_filter)
+
+        return query
+
+    # ----
+
+    def set_watermark(self, column_name, last_value=None, max_value=None):
+
+        """ Only read rows with a watermark column value after last_value ( and up to max_value )
+            For delta sync: the watermark column is for example an updated_at column or an increasing id
+        
+        :param column_name: name of watermark column
+        :param last_value: string of value of last sync ( None: from the start )
+        :param max_value: string of highest value at start of this sync ( None: no upper bound )
+        
+        """
+
+        self.watermark = (column_name, last_value, max_value) if column_name else None
+
+    # ----
+
+    def get_watermark_filters(self):
+
+        """ Filters of watermark on queries: column > last_value AND column <= max_value
+        
+        :returns: list of SQLAlchemy expressions --
+        
+        """
+
+        if self.watermark is None:
+            return []
+
+        column_name, last_value, max_value = self.watermark
+        column = getattr(self.model_class, column_name)
+
+        filters = []
+
+        if last_value is not None:
+            filters.append(column > self.get_watermark_literal(column_name, last_value))
+        if max_value is not None:
+            filters.append(column <= self.get_watermark_literal(column_name, max_value))
+
+        return filters
+
+    # ----
+
+    def get_watermark_literal(self, column_name, value):
+
+        # stored watermark is a string: convert to the type of the column in the source database
+        column_type = self.sqla_table.c[column_name].type
+
+        try:
+            python_type = column_type.python_type
+        except NotImplementedError:
+            python_type = str
+
+        if python_type in (datetime.datetime, datetime.date):
+            value = python_type.fromisoformat(value)
+        elif python_type in (int, Decimal, float):
+            value = Decimal(value)
+
+        return literal(value, type_=column_type)
+
+    # ----
+
+    def get_watermark_max(self, column_name, last_value=None):
+
+        """ Highest value of watermark column ( after last_value ): the watermark of this sync
+        
+        :returns: string or None -- None when there are no ( new ) rows
+        
+        """
+
+        if not self.model_class:
+            self.get_model(manual_primary_key=self.primary_key)
+
+        column = getattr(self.model_class, column_name)
+        query = self.session.query(func.max(column))
+
+        if last_value is not None:
+            query = query.filter(column > self.get_watermark_literal(column_name, last_value))
+
+        max_value = query.scalar()
+
+        if max_value is None:
+            return None
+
+        return str(max_value)  # NOTE: dates and times in ISO format
+
+    # ----
+
+    def get_key_column(self):
+
+        """ Get the SQLAlchemy column the model uses as (first) primary key
+        
+        :returns: SQLAlchemy Column or None -- 
+        
+        """
+
+        if not self.model_class:
+            self.get_model(manual_primary_key=self.primary_key)
+
+        if self.model_class is None:
+            return None
+
+        try:
+            return inspect(self.model_class).primary_key[0]
+        except Exception as e:
+            self.logger.error("No key column for table '{0}': {1}".format(self.name, e))
+            return None
+
+    # ----
+
+    def has_sortable_key(self):
+
+        """ Check if we can safely page through this table with a keyset ( WHERE key > :last )
+        
+            That is only the case with one unique and orderable key: a real primary key constraint 
+            or a primary key set manually in the pipeline. For views the key is just a guess by name
+            and might not be unique, then we need to fall back on offset
+        
+        :returns: Boolean --
+        
+        """
+
+        key_column = self.get_key_column()
+
+        if key_column is None:
+            return False
+
+        if len(inspect(self.model_class).primary_key) != 1:
+            return False  # composite keys need row comparison: not supported by all source databases
+
+        if isinstance(key_column.type, (SQLA_JSONB, SQLA_ARRAY)):
+            return False
+
+        if self.primary_key is not None:
+            return True  # manually set: we trust it to be unique
+
+        return self.columns.get(key_column.name, {}).get('reflected_primary', False)
+
+    # ----
+
+    def get_keyset_batch(self, last_key=None, limit=50, columns=None):
+
+        """ Get next batch of rows after the last seen key: WHERE key > :last ORDER BY key LIMIT n
+            Every batch costs the same, unlike offset which scans all rows before it
+        
+        :param last_key: value of key column of last row of previous batch ( None for first batch )
+        :param limit: size of batch
+        :param columns: list of column names to select ( see start_select ), None for ORM rows
+        :returns: list of ORM model rows or tuples
+        
+        """
+
+        if columns is not None:
+            query = self.start_select(columns)
+        else:
+            query = self.start_query()
+
+        if query is False:
+            return []
+
+        if last_key is not None:
+            if columns is not None:
+                query = query.where(self.get_key_column() > last_key)
+            else:
+                query = query.filter(self.get_key_column() > last_key)
+
+        if columns is not None:
+            return self.session.execute(query.limit(limit)).fetchall()
+
+        return query.limit(limit).all()
+
+    # ----
+
+    def get_offset_batch(self, batch_num=0, limit=50, columns=None):
+
+        """ Get batch of rows by offset: only for tables without sortable key
+        
+        :param columns: list of column names to select ( see start_select ), None for ORM rows
+        :returns: list of ORM model rows or tuples
+        
+        """
+
+        if columns is not None:
+            query = self.start_select(columns)
+        else:
+            query = self.start_query()
+
+        if query is False:
+            return []
+
+        query = query.offset(batch_num * limit).limit(limit)
+
+        if columns is not None:
+            return self.session.execute(query).fetchall()
+
+        return query.all()
+
+    # ----
+
+    def get_streamed_batches(self, batch_size=50, columns=None):
+
+        """ Generator of batches from one query over a server side cursor
+        
+            Instead of one query per batch we open one named cursor ( stream_results ) and fetch 
+            batch_size rows at a time from it ( yield_per ). Memory on our side stays the same for 
+            every table size and the source database plans the query only once
+        
+        :param batch_size: number of rows per batch
+        :param columns: list of column names to select ( see start_select ), None for ORM rows
+        :returns: generator of lists of ORM model rows or tuples
+        
+        """
+
+        if columns is not None:
+            query = self.start_select(columns)
+        else:
+            query = self.start_query()
+
+        if query is False:
+            return
+
+        if columns is not None:
+            result = self.session.execute(query.execution_options(stream_results=True))
+
+            while True:
+                batch = result.fetchmany(batch_size)
+
+                if len(batch) == 0:
+                    result.close()
+                    return
+
+                yield batch
+
+        rows = iter(query.execution_options(stream_results=True).yield_per(batch_size))
+
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+
+            if len(batch) == 0:
+                return
+
+            yield batch
+
+    # ----
+
+    def get_key_value(self, row):
+
+        # value of key column of an ORM model row ( or selected tuple )
+        return getattr(row, self.get_key_column().key)
+
     # ==== utils ==== #
 
     def create_logger(self):
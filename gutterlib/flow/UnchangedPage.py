@@ -0,0 +1,25 @@
+class UnchangedPage:
+
+    """ Page of an API that did not change since the last run ( server answered 304 Not Modified )
+
+        Stands in for the rows of the page: len() is the number of rows the page had, 
+        so it only ends the paging when the page was empty before
+
+    """
+
+    def __init__(self, url, num_rows=0):
+
+        self.url = url
+        self.num_rows = num_rows
+
+    # ----
+
+    def __repr__(self):
+
+        return "<UnchangedPage url='{0}', num_rows={1}>".format(self.url, self.num_rows)
+
+    # ----
+
+    def __len__(self):
+
+        return self.num_rows
@@ -0,0 +1,156 @@
+import decimal
+import json
+import os
+import unittest
+
+try:
+    from sqlalchemy import cast, text, Numeric, String
+    from sqlalchemy.dialects import postgresql
+    from gutterlib.datastore.GutterStore import GutterStore
+except ImportError:  # needs sqlalchemy
+    GutterStore = None
+
+# paging against a real database ( like GUTTER_DB_* in api.py ): tables are created and dropped in schema gutter_data
+TEST_DATABASE = {'db_type': os.environ.get('GUTTER_TEST_DB_TYPE'),
+                 'url': os.environ.get('GUTTER_TEST_DB_URL'),
+                 'port': os.environ.get('GUTTER_TEST_DB_PORT'),
+                 'user': os.environ.get('GUTTER_TEST_DB_USER'),
+                 'password': os.environ.get('GUTTER_TEST_DB_PASSWORD'),
+                 'name': os.environ.get('GUTTER_TEST_DB_NAME')}
+
+TEST_TABLE = 'test_data_cursor'
+SCHEMA_DEFINITION = {'title': TEST_TABLE, 'properties': {'n': {'type': 'number'}, 's': {'type': 'string'}}}
+
+
+@unittest.skipIf(GutterStore is None, "needs sqlalchemy")
+class TestCursorFilter(unittest.TestCase):
+
+    def setUp(self):
+
+        self.gutter_store = GutterStore()
+        self.StorageModel = self.gutter_store.get_storage_model(TEST_TABLE)
+        self.sort_key = cast(self.StorageModel.data['n'].astext, Numeric)
+
+    def get_sql(self, is_descending, value):
+
+        cursor_filter = self.gutter_store.get_cursor_filter(self.StorageModel, self.sort_key, Numeric, is_descending,
+                                                            {'id': '7', 'value': value})
+
+        return str(cursor_filter.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+
+    def test_ascending(self):
+
+        # NULL is the biggest value: rows without sort value come after all others
+        self.assertEqual(self.get_sql(False, decimal.Decimal('1.5')),
+                         "(CAST((gutter_data.test_data_cursor.data ->> 'n') AS NUMERIC), gutter_data.test_data_cursor.id) "
+                         "> (1.5, '7') OR CAST((gutter_data.test_data_cursor.data ->> 'n') AS NUMERIC) IS NULL")
+
+    def test_ascending_after_null(self):
+
+        self.assertEqual(self.get_sql(False, None),
+                         "CAST((gutter_data.test_data_cursor.data ->> 'n') AS NUMERIC) IS NULL "
+                         "AND gutter_data.test_data_cursor.id > '7'")
+
+    def test_descending(self):
+
+        self.assertEqual(self.get_sql(True, decimal.Decimal('1.5')),
+                         "(CAST((gutter_data.test_data_cursor.data ->> 'n') AS NUMERIC), gutter_data.test_data_cursor.id) "
+                         "< (1.5, '7')")
+
+    def test_descending_after_null(self):
+
+        # rows without sort value come first: then all rows with a value
+        self.assertEqual(self.get_sql(True, None),
+                         "CAST((gutter_data.test_data_cursor.data ->> 'n') AS NUMERIC) IS NULL "
+                         "AND gutter_data.test_data_cursor.id < '7' "
+                         "OR CAST((gutter_data.test_data_cursor.data ->> 'n') AS NUMERIC) IS NOT NULL")
+
+    def test_without_order_by(self):
+
+        cursor_filter = self.gutter_store.get_cursor_filter(self.StorageModel, None, None, False, {'id': 7})
+
+        self.assertEqual(str(cursor_filter.compile(dialect=postgresql.dialect(),
+                                                   compile_kwargs={'literal_binds': True})),
+                         "gutter_data.test_data_cursor.id > '7'")
+
+
+@unittest.skipIf(GutterStore is None, "needs sqlalchemy")
+class TestCursorToken(unittest.TestCase):
+
+    def test_decimal_round_trip(self):
+
+        # more digits than a float has: the next page has to start exactly after this value
+        cursor = {'order_by': 'n', 'desc': False, 'id': '7', 'value': decimal.Decimal('0.10000000000000000000000001')}
+
+        decoded = GutterStore.decode_cursor(GutterStore.encode_cursor(cursor))
+
+        self.assertEqual(decoded, cursor)
+        self.assertIsInstance(decoded['value'], decimal.Decimal)
+
+    def test_invalid_token(self):
+
+        self.assertIsNone(GutterStore.decode_cursor('not a cursor'))
+        self.assertIsNone(GutterStore.decode_cursor(GutterStore.encode_cursor({'order_by': None})))
+
+
+@unittest.skipIf(GutterStore is None or TEST_DATABASE['db_type'] is None, "needs a test database")
+class TestDataPages(unittest.TestCase):
+
+    PAGE_SIZE = 3
+
+    def setUp(self):
+
+        self.gutter_store = GutterStore()
+        self.assertTrue(self.gutter_store.connect(**TEST_DATABASE))
+
+        engine = self.gutter_store.db_engine
+        engine.execute('CREATE SCHEMA IF NOT EXISTS gutter_data')
+        engine.execute('DROP TABLE IF EXISTS gutter_data."{0}"'.format(TEST_TABLE))
+
+        self.gutter_store.get_storage_model(TEST_TABLE)().create_table(engine)
+
+        # duplicate, missing and null sort values
+        rows = [{'n': 2, 's': 'b'}, {'n': 1, 's': 'a'}, {'n': None, 's': None}, {'n': 2, 's': 'b'}, {},
+                {'n': 1.5, 's': 'c'}, {'n': None}, {'n': 3, 's': 'a'}, {'n': 1, 's': 'd'}, {'s': 'b'}]
+
+        for num, data in enumerate(rows):
+            engine.execute(text('INSERT INTO gutter_data."{0}" (id, created_at, created_by, data) '
+                                'VALUES (:id, now(), :created_by, CAST(:data AS jsonb))'.format(TEST_TABLE)),
+                           {'id': 'row{0:02d}'.format(num), 'created_by': 'test', 'data': json.dumps(data)})
+
+    def tearDown(self):
+
+        self.gutter_store.db_session.rollback()
+        self.gutter_store.db_engine.execute('DROP TABLE IF EXISTS gutter_data."{0}"'.format(TEST_TABLE))
+        self.gutter_store.disconnect()
+
+    def get_pages(self, order_by, order_by_type, as_text):
+
+        pages = []
+        after = None
+
+        while True:
+            rows, after = self.gutter_store.get_data_page(TEST_TABLE, SCHEMA_DEFINITION, limit=self.PAGE_SIZE,
+                                                          order_by=order_by, order_by_type=order_by_type,
+                                                          after=after, as_text=as_text)
+            rows = json.loads(rows) if as_text else rows
+
+            pages.append(([row['_id'] for row in rows], after))
+
+            if after is None or len(pages) > 10:
+                return pages
+
+    def test_text_and_list_pages_are_the_same(self):
+
+        for order_by in [None, 'n', 's']:
+            for order_by_type in ['asc', 'desc']:
+                list_pages = self.get_pages(order_by, order_by_type, as_text=False)
+                text_pages = self.get_pages(order_by, order_by_type, as_text=True)
+
+                self.assertEqual(list_pages, text_pages, (order_by, order_by_type))
+                self.assertEqual(sorted(id for ids, after in list_pages for id in ids),
+                                 ['row{0:02d}'.format(num) for num in range(10)], (order_by, order_by_type))
+
+
+if __name__ == '__main__':
+    unittest.main()
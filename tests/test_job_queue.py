@@ -0,0 +1,37 @@
+import threading
+import unittest
+
+try:
+    from gutterlib.flow.JobQueue import JobQueue
+except ImportError:  # needs sqlalchemy
+    JobQueue = None
+
+
+@unittest.skipIf(JobQueue is None, "needs sqlalchemy")
+class TestHeartbeat(unittest.TestCase):
+
+    def run_heartbeats(self, results):
+
+        job_queue = JobQueue(db_engine=None, runner_id='runner')
+        job_queue.HEARTBEAT_SECONDS = 0.01
+        job_queue.heartbeat = lambda job_id: results.pop(0) if results else True
+
+        lost_lease = threading.Event()
+        stop = job_queue.start_heartbeat(1, lost_lease)
+        lost = lost_lease.wait(0.5)
+        stop.set()
+
+        return lost
+
+    def test_lost_lease_is_signalled(self):
+
+        self.assertTrue(self.run_heartbeats([True, False]))
+
+    def test_failed_heartbeat_is_not_a_lost_lease(self):
+
+        # database not reachable for a moment: the lease is longer than the heartbeat interval
+        self.assertFalse(self.run_heartbeats([None, None]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import datetime
+import unittest
+import uuid
+
+from decimal import Decimal
+
+try:
+    from gutterlib.flow.JsonCoercer import JsonCoercer
+except ImportError:  # needs simplejson
+    JsonCoercer = None
+
+
+@unittest.skipIf(JsonCoercer is None, "needs simplejson")
+class TestJsonCoercer(unittest.TestCase):
+
+    def test_decimal(self):
+
+        # like the JSON round trip: no exponent gives an integer
+        self.assertEqual(JsonCoercer.to_json_value(Decimal('5')), 5)
+        self.assertIs(type(JsonCoercer.to_json_value(Decimal('5'))), int)
+        self.assertIs(type(JsonCoercer.to_json_value(Decimal('5.0'))), float)
+        self.assertEqual(JsonCoercer.to_json_value(Decimal('1.25')), 1.25)
+
+        convert = JsonCoercer.get_converter({'type': 'number'}, 'NUMERIC')
+        self.assertEqual(convert(Decimal('-0.5')), -0.5)
+        self.assertEqual(convert(7), 7)
+        self.assertIsNone(convert(None))
+
+    def test_datetime(self):
+
+        # str() format of before: 'YYYY-MM-DD HH:MM:SS', no 'T'
+        self.assertEqual(JsonCoercer.to_json_value(datetime.datetime(2020, 1, 2, 3, 4, 5)), '2020-01-02 03:04:05')
+        self.assertEqual(JsonCoercer.to_json_value(datetime.datetime(2020, 1, 2, 3, 4, 5, 60)),
+                         '2020-01-02 03:04:05.000060')
+        self.assertEqual(JsonCoercer.to_json_value(datetime.date(2020, 1, 2)), '2020-01-02')
+        self.assertEqual(JsonCoercer.to_json_value(datetime.time(3, 4)), '03:04:00')
+
+        convert = JsonCoercer.get_converter({'type': 'string', 'format': 'date-time'}, 'TIMESTAMP')
+        self.assertEqual(convert(datetime.datetime(2020, 1, 2, 3, 4, 5)), '2020-01-02 03:04:05')
+        self.assertEqual(convert('2020-01-02'), '2020-01-02')
+
+    def test_bytes(self):
+
+        for value in [b'\x00\xff', bytearray(b'\x00\xff'), memoryview(b'\x00\xff')]:
+            self.assertEqual(JsonCoercer.to_json_value(value), 'AP8=')
+
+        # binary columns by type of source column
+        convert = JsonCoercer.get_converter({'type': 'string'}, 'BYTEA')
+        self.assertEqual(convert(memoryview(b'gutter')), 'Z3V0dGVy')
+        self.assertIsNone(convert(None))
+
+    def test_nan_and_infinity(self):
+
+        # not JSON: Postgres does not accept them in a jsonb column
+        for value in [float('nan'), float('inf'), float('-inf'), Decimal('NaN'), Decimal('Infinity')]:
+            self.assertIsNone(JsonCoercer.to_json_value(value))
+
+        self.assertEqual(JsonCoercer.to_json_value({'a': [1.5, float('nan')]}), {'a': [1.5, None]})
+        self.assertIsNone(JsonCoercer.get_converter({'type': 'number'})(float('nan')))
+
+    def test_same_as_json_round_trip(self):
+
+        # stored data and data hashes must not change
+        values = [None, True, 3, 'text', 1.5, Decimal('5'), Decimal('2.50'), uuid.UUID(int=1),
+                  datetime.datetime(2020, 1, 2, 3, 4, 5), {'a': (1, 2), 1: None, None: 'x'}, [[Decimal('1.1')]]]
+
+        for value in values:
+            self.assertEqual(JsonCoercer.to_json_value(value), JsonCoercer.serialize(value), value)
+
+
+if __name__ == '__main__':
+    unittest.main()
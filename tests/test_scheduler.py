@@ -0,0 +1,146 @@
+import datetime
+import unittest
+
+from gutterlib.flow.CronExpression import CronExpression
+from gutterlib.flow.Scheduler import Scheduler
+
+try:
+    from gutterlib.flow.Pipeline import Pipeline
+except ImportError:  # needs sqlalchemy
+    Pipeline = None
+
+
+class TestCronExpression(unittest.TestCase):
+
+    def test_next_matches_hour_and_minute(self):
+
+        cron = CronExpression('30 4 * * *')
+
+        self.assertEqual(cron.get_next(datetime.datetime(2020, 1, 1, 3, 0)), datetime.datetime(2020, 1, 1, 4, 30))
+        self.assertEqual(cron.get_next(datetime.datetime(2020, 1, 1, 4, 30)), datetime.datetime(2020, 1, 2, 4, 30))
+
+    def test_steps_and_week_days(self):
+
+        cron = CronExpression('*/15 6-18 * * 1-5')
+
+        # saturday evening: next is monday morning
+        self.assertEqual(cron.get_next(datetime.datetime(2020, 1, 4, 20, 0)), datetime.datetime(2020, 1, 6, 6, 0))
+        self.assertEqual(cron.get_next(datetime.datetime(2020, 1, 6, 6, 1)), datetime.datetime(2020, 1, 6, 6, 15))
+
+    def test_invalid_expression(self):
+
+        with self.assertRaises(ValueError):
+            CronExpression('61 * * * *')
+
+        with self.assertRaises(ValueError):
+            CronExpression('* * *')
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_never_run(self):
+
+        now = datetime.datetime(2020, 1, 1, 3, 0)
+
+        # every: directly, at and cron: wait for their time
+        self.assertEqual(Scheduler.get_next_fire_time({'type': 'every', 'minutes': 5}, None, now), now)
+        self.assertEqual(Scheduler.get_next_fire_time({'type': 'at', 'hour': 4, 'minute': 30}, None, now),
+                         datetime.datetime(2020, 1, 1, 4, 30))
+        self.assertEqual(Scheduler.get_next_fire_time({'type': 'cron', 'cron': '0 4 * * *'}, None, now),
+                         datetime.datetime(2020, 1, 1, 4, 0))
+
+    def test_never_run_at_pipeline_is_popped_at_its_time(self):
+
+        run_at = {'type': 'at', 'hour': 4, 'minute': 30}
+        reload_time = datetime.datetime(2020, 1, 1, 3, 0)
+
+        scheduler = Scheduler()
+        scheduler.schedule(1, 'pipeline', run_at, None, reload_time)
+
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2020, 1, 1, 4, 29)), [])
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2020, 1, 1, 4, 30, 0, 500)),
+                         [(1, 'pipeline', datetime.datetime(2020, 1, 1, 4, 30))])
+
+    def test_missed_run_without_catch_up_fires_at_next_time(self):
+
+        # missed 2020-01-02: when the runner pops 2020-01-03 04:30 a little late it is still due
+        run_at = {'type': 'at', 'hour': 4, 'minute': 30, 'catch_up': False}
+        last_run = datetime.datetime(2020, 1, 1, 4, 30)
+        fire_time = datetime.datetime(2020, 1, 3, 4, 30)
+
+        self.assertEqual(Scheduler.get_next_fire_time(run_at, last_run, datetime.datetime(2020, 1, 3, 4, 30, 0, 500000)),
+                         fire_time)
+
+        scheduler = Scheduler()
+        scheduler.schedule(1, 'pipeline', run_at, last_run, datetime.datetime(2020, 1, 3, 0, 0))
+
+        self.assertEqual(scheduler.pop_due(fire_time + datetime.timedelta(seconds=0.5)), [(1, 'pipeline', fire_time)])
+
+    def test_after_run(self):
+
+        last_run = datetime.datetime(2020, 1, 1, 4, 30, 10)
+        now = datetime.datetime(2020, 1, 1, 12, 0)
+
+        self.assertEqual(Scheduler.get_next_fire_time({'type': 'at', 'hour': 4, 'minute': 30}, last_run, now),
+                         datetime.datetime(2020, 1, 2, 4, 30))
+        self.assertEqual(Scheduler.get_next_fire_time({'type': 'every', 'minutes': 5}, last_run, now),
+                         last_run + datetime.timedelta(minutes=5))
+
+    def test_missed_run_without_catch_up(self):
+
+        last_run = datetime.datetime(2020, 1, 1, 4, 30)
+        now = datetime.datetime(2020, 1, 3, 12, 0)
+
+        self.assertEqual(Scheduler.get_next_fire_time({'type': 'at', 'hour': 4, 'minute': 30}, last_run, now),
+                         datetime.datetime(2020, 1, 2, 4, 30))  # catch up: due directly
+        self.assertEqual(Scheduler.get_next_fire_time({'type': 'at', 'hour': 4, 'minute': 30, 'catch_up': False},
+                                                      last_run, now),
+                         datetime.datetime(2020, 1, 4, 4, 30))
+
+    def test_replaced_schedule(self):
+
+        now = datetime.datetime(2020, 1, 1, 12, 0)
+
+        scheduler = Scheduler()
+        scheduler.schedule(1, 'pipeline', {'type': 'every', 'minutes': 5}, now - datetime.timedelta(minutes=10), now)
+        scheduler.schedule(1, 'pipeline', {'type': 'every', 'minutes': 5}, now, now)
+
+        self.assertEqual(scheduler.pop_due(now), [])
+        self.assertEqual(scheduler.get_seconds_until_next(now), 300.0)
+
+    def test_invalid_run_at(self):
+
+        scheduler = Scheduler()
+
+        self.assertIsNone(scheduler.schedule(1, 'pipeline', {'type': 'sometimes'}))
+        self.assertIsNone(scheduler.get_seconds_until_next())
+
+
+@unittest.skipIf(Pipeline is None, "needs sqlalchemy")
+class TestPipelineNeedsDoing(unittest.TestCase):
+
+    def make_pipeline(self, run_at, last_run=None):
+
+        return Pipeline(name='pipeline', type='api', data_source={}, run_at=run_at, last_run=last_run)
+
+    def test_popped_fire_time_is_trusted(self):
+
+        # the missed run without catch up: computed again from last_run it would move to the next day
+        pipeline = self.make_pipeline({'type': 'at', 'hour': 4, 'minute': 30, 'catch_up': False},
+                                      datetime.datetime(2020, 1, 1, 4, 30))
+
+        self.assertTrue(pipeline.needs_doing(datetime.datetime(2020, 1, 3, 4, 30)))
+        self.assertFalse(pipeline.needs_doing(datetime.datetime.now() + datetime.timedelta(hours=1)))
+
+    def test_guards(self):
+
+        pipeline = self.make_pipeline({'type': 'every', 'minutes': 5}, datetime.datetime.now())
+        self.assertFalse(pipeline.needs_doing(datetime.datetime(2020, 1, 1)))  # run under a minute ago
+
+        pipeline = self.make_pipeline({'type': 'every', 'minutes': 5})
+        pipeline.executing = True
+        self.assertFalse(pipeline.needs_doing(datetime.datetime(2020, 1, 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()